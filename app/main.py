@@ -36,7 +36,7 @@ def main():
         
         # Define message handler callback
         def on_message(data):
-            workflow_manager.handle_message(data)
+            workflow_manager.dispatch_message(data)
         
         # Define placeholder callbacks
         def on_qrcode(data):
@@ -63,6 +63,7 @@ def main():
             if websocket_manager.is_connected():
                 websocket_manager.disconnect()
                 logger.info("WebSocket disconnected")
+            workflow_manager.shutdown()
     
     except Exception as e:
         logger.error(f"Failed to start Document Scanner service: {str(e)}")
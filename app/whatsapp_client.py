@@ -8,6 +8,7 @@ import logging
 import mimetypes
 from evolutionapi.client import EvolutionClient
 from evolutionapi.models.message import TextMessage, MediaMessage
+from evolutionapi.models.websocket import WebSocketConfig
 
 from config.settings import BASE_URL, API_TOKEN, INSTANCE_ID, INSTANCE_TOKEN
 
@@ -115,8 +116,6 @@ class WhatsAppClient:
         Returns:
             websocket_manager: The configured WebSocket manager
         """
-        from evolutionapi.models.websocket import WebSocketConfig
-        
         try:
             websocket_config = WebSocketConfig(
                 enabled=True, 
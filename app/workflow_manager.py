@@ -6,7 +6,11 @@ import os
 import uuid
 import base64
 import logging
-from utils.file_utils import cleanup_task_universal, read_order_file
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader
+from utils.file_utils import cleanup_task_universal, format_file_size, ConvertedDocument
 
 from workflows.merge_workflow import MergeWorkflow
 from workflows.split_workflow import SplitWorkflow
@@ -17,10 +21,27 @@ from workflows.excel_to_pdf_workflow import ExcelToPdfWorkflow
 from workflows.compress_pdf_workflow import CompressPdfWorkflow
 from workflows.markdown_to_pdf_workflow import MarkdownToPdfWorkflow
 
-from config.settings import DOWNLOAD_BASE_DIR
+from config.settings import DOWNLOAD_BASE_DIR, MESSAGE_WORKERS
 
 logger = logging.getLogger(__name__)
 
+# Seconds shutdown waits for every worker thread to pick up its browser close task
+BROWSER_CLOSE_TIMEOUT = 30
+
+# Text commands that start a workflow, mapped to the workflow type
+START_COMMANDS = {
+    'merge pdf': "merge",
+    'split pdf': "split",
+    'scan document': "scan",
+    'word to pdf': "word_to_pdf",
+    'powerpoint to pdf': "powerpoint_to_pdf",
+    'excel to pdf': "excel_to_pdf",
+    'compress pdf': "compress",
+    # Both markdown commands use the same consolidated workflow
+    'markdown to pdf': "markdown_to_pdf",
+    'markdown2 to pdf': "markdown_to_pdf",
+}
+
 class WorkflowManager:
     """Manages workflows for document processing tasks."""
     
@@ -34,6 +55,16 @@ class WorkflowManager:
         self.whatsapp_client = whatsapp_client
         self.active_workflows = {}
         
+        # Per-sender FIFO queues drained on a shared pool: a long compression or
+        # conversion for one user no longer holds up everyone else's messages,
+        # while each user's own messages are still handled strictly in order
+        self._executor = ThreadPoolExecutor(
+            max_workers=MESSAGE_WORKERS,
+            thread_name_prefix="workflow"
+        )
+        self._sender_queues = {}
+        self._queue_lock = threading.Lock()
+        
     def start_workflow(self, sender_jid, workflow_type):
         """
         Start a new workflow for a user.
@@ -50,13 +81,13 @@ class WorkflowManager:
         instruction_message = ""
         
         if workflow_type == "merge":
-            initial_state = {"merge_order": {}}
+            initial_state = {"merge_order": {}, "max_order": 0}
             instruction_message = "Started PDF Merge. Send PDFs one by one.\nReply to a PDF with just a number (e.g., '1') to change order.\nSend 'done' when finished."
         elif workflow_type == "split":
             initial_state = {"split_files": {}}
             instruction_message = "Started PDF Split. Send the PDF file to split.\nThen, *reply to that PDF message* with page ranges (e.g., '1-10', '15', '20-25', one per line or comma-separated)."
         elif workflow_type == "scan":
-            initial_state = {"scan_order": {}, "images": []}
+            initial_state = {"scan_order": {}, "max_order": 0, "images": []}
             instruction_message = "Started Document Scan. Send images one by one.\nReply to an image with a number to change order.\nSend 'done' when finished."
         elif workflow_type == "word_to_pdf":
             initial_state = {}
@@ -71,7 +102,7 @@ class WorkflowManager:
             initial_state = {"compress_files": {}}
             instruction_message = "Started PDF Compression. Send your PDF files one by one, and I'll help you compress them to reduce file size while maintaining quality.\nFor each PDF, you can choose compression level: 'low', 'medium', 'high', 'max', or 'auto'.\nSend 'done' when you've sent all PDFs to compress."
         elif workflow_type == "markdown_to_pdf":
-            initial_state = {"markdown_content": [], "message_ids": []}
+            initial_state = {"markdown_content": bytearray(), "message_ids": []}
             instruction_message = "Started Markdown to PDF conversion. Send your markdown text messages one by one. All messages will be combined in sequence.\nUse standard markdown formatting (# for headings, ** for bold, etc.).\nSend 'done' when you've finished sending all markdown text."
         else:
             return False, "Invalid workflow type."
@@ -137,7 +168,7 @@ class WorkflowManager:
                 f.write(base64.b64decode(base64_string))
 
             if wf_type == "merge":
-                return MergeWorkflow.handle_pdf_save(task_dir, message_id, saved_filename)
+                return MergeWorkflow.handle_pdf_save(task_dir, message_id, saved_filename, workflow_info)
             
             elif wf_type == "split":
                 result, message = SplitWorkflow.handle_pdf_save(task_dir, message_id, saved_filename, workflow_info)
@@ -242,9 +273,7 @@ class WorkflowManager:
 
         # Save original filename in workflow_info
         if filename:
-            if 'original_filenames' not in workflow_info:
-                workflow_info['original_filenames'] = {}
-            workflow_info['original_filenames'][message_id] = filename
+            workflow_info.setdefault('documents', {})[message_id] = ConvertedDocument(original_name=filename)
             logger.info(f"Saved original filename: {filename} for message {message_id}")
             
         # For PDF files, use handle_pdf_save instead
@@ -391,9 +420,9 @@ class WorkflowManager:
         target_filename = f"{quoted_stanza_id}{extension}"
         
         if wf_type == "merge":
-            success, message = MergeWorkflow.handle_order_override(task_dir, target_filename, new_order_str)
+            success, message = MergeWorkflow.handle_order_override(task_dir, target_filename, new_order_str, workflow_info)
         else:  # scan
-            success, message = ScanWorkflow.handle_order_override(task_dir, target_filename, new_order_str)
+            success, message = ScanWorkflow.handle_order_override(task_dir, target_filename, new_order_str, workflow_info)
         
         self.whatsapp_client.send_text(sender_jid, message)
     
@@ -410,12 +439,12 @@ class WorkflowManager:
         task_dir = workflow_info["task_dir"]
         
         if message_text.lower() == 'done':
-            order_data = read_order_file(task_dir)
+            order_data = workflow_info.get("merge_order", {})
             if not order_data:
                 self.whatsapp_client.send_text(sender_jid, "No PDFs received for merge.")
                 del self.active_workflows[sender_jid]
                 return
-                
+            
             merged_pdf_path, missing_files = MergeWorkflow.merge_pdfs_in_order(task_dir, order_data)
             sent_message_id = None
             final_output_files = []
@@ -465,7 +494,6 @@ class WorkflowManager:
             source_path = os.path.join(task_dir, source_filename)
 
             try:
-                from pypdf import PdfReader
                 reader = PdfReader(source_path)
                 total_pages = len(reader.pages)
                 
@@ -525,7 +553,7 @@ class WorkflowManager:
         task_dir = workflow_info["task_dir"]
         
         if message_text.lower() == 'done':
-            order_data = read_order_file(task_dir)
+            order_data = workflow_info.get("scan_order", {})
             if not order_data:
                 self.whatsapp_client.send_text(sender_jid, "No images received for scanning.")
                 del self.active_workflows[sender_jid]
@@ -614,11 +642,10 @@ class WorkflowManager:
                 })
         
         # Determine which files to clean up
-        input_files = []
-        if 'document_versions' in workflow_info:
-            for versions in workflow_info['document_versions'].values():
-                if 'original' in versions:
-                    input_files.append(versions['original'])
+        input_files = [
+            document.original for document in workflow_info.get('documents', {}).values()
+            if document.original
+        ]
         
         # Cleanup
         if output_files:
@@ -676,11 +703,10 @@ class WorkflowManager:
                 })
         
         # Determine which files to clean up
-        input_files = []
-        if 'presentation_versions' in workflow_info:
-            for versions in workflow_info['presentation_versions'].values():
-                if 'original' in versions:
-                    input_files.append(versions['original'])
+        input_files = [
+            document.original for document in workflow_info.get('documents', {}).values()
+            if document.original
+        ]
         
         # Cleanup
         if output_files:
@@ -738,11 +764,10 @@ class WorkflowManager:
                 })
         
         # Determine which files to clean up
-        input_files = []
-        if 'spreadsheet_versions' in workflow_info:
-            for versions in workflow_info['spreadsheet_versions'].values():
-                if 'original' in versions:
-                    input_files.append(versions['original'])
+        input_files = [
+            document.original for document in workflow_info.get('documents', {}).values()
+            if document.original
+        ]
         
         # Cleanup
         if output_files:
@@ -768,7 +793,8 @@ class WorkflowManager:
         
         # Handle compression level selection for specific PDF
         compress_files = workflow_info.get("compress_files", {})
-        if not compress_files:
+        pending_ids = [message_id for message_id, entry in compress_files.items() if entry.pending]
+        if not pending_ids:
             if message_text.lower() == 'done':
                 self.whatsapp_client.send_text(sender_jid, "No PDFs received for compression.")
                 del self.active_workflows[sender_jid]
@@ -779,31 +805,18 @@ class WorkflowManager:
             self.whatsapp_client.send_text(sender_jid, "Processing PDFs for compression... This may take a moment.")
             
             output_files = []
-            for message_id, pdf_filename in compress_files.items():
-                # Check if this PDF has already been compressed
-                if "compressed_versions" in workflow_info and message_id in workflow_info["compressed_versions"]:
-                    continue
-                    
-                # Use medium compression by default
-                result = CompressPdfWorkflow.compress_single_pdf(task_dir, pdf_filename, "medium")
-                
+            
+            # Compress every PDF that hasn't been compressed yet, using medium by default
+            uncompressed_ids = [
+                message_id for message_id in pending_ids
+                if compress_files[message_id].stats is None
+            ]
+            results = CompressPdfWorkflow.compress_batch(workflow_info, uncompressed_ids, "medium")
+            
+            for result in results.values():
                 if result["success"]:
-                    # Store the compressed version info
-                    if "compressed_versions" not in workflow_info:
-                        workflow_info["compressed_versions"] = {}
-                        
-                    workflow_info["compressed_versions"][message_id] = {
-                        "original": pdf_filename,
-                        "compressed": os.path.basename(result["path"]),
-                        "stats": {
-                            "original_size": result["original_size"],
-                            "compressed_size": result["compressed_size"],
-                            "reduction": result["reduction"]
-                        }
-                    }
-                    
                     # Send the compressed PDF to the user
-                    result_caption = f"Compressed PDF: {result['reduction']:.1f}% reduction ({result['original_size']:.1f} KB → {result['compressed_size']:.1f} KB)"
+                    result_caption = f"Compressed PDF: {result['reduction']:.1f}% reduction ({format_file_size(result['original_size'] * 1024)} → {format_file_size(result['compressed_size'] * 1024)})"
                     
                     _, sent_id = self.whatsapp_client.send_media(
                         sender_jid,
@@ -818,10 +831,10 @@ class WorkflowManager:
                         })
             
             # Get all input files for cleanup
-            input_files = []
-            if "compressed_versions" in workflow_info:
-                for versions in workflow_info["compressed_versions"].values():
-                    input_files.append(versions["original"])
+            input_files = [
+                entry.saved_filename for entry in compress_files.values()
+                if entry.stats is not None
+            ]
             
             # Cleanup
             if output_files:
@@ -838,8 +851,7 @@ class WorkflowManager:
             return
             
         # Handle compression level selection for the most recently received PDF
-        last_received_message_id = next(reversed(compress_files))
-        pdf_filename = compress_files[last_received_message_id]
+        last_received_message_id = pending_ids[-1]
         
         # Check if a valid compression level was specified
         compression_level = message_text.lower()
@@ -853,40 +865,25 @@ class WorkflowManager:
             )
             
             # Process the PDF with the specified compression level
-            result = CompressPdfWorkflow.compress_single_pdf(
-                task_dir, 
-                pdf_filename, 
-                compression_level if not is_auto else "medium", 
+            result = CompressPdfWorkflow.compress_and_record(
+                workflow_info,
+                last_received_message_id,
+                compression_level if not is_auto else "medium",
                 auto_level=is_auto
             )
             
             if result["success"]:
-                # Store the compressed version info
-                if "compressed_versions" not in workflow_info:
-                    workflow_info["compressed_versions"] = {}
-                    
-                workflow_info["compressed_versions"][last_received_message_id] = {
-                    "original": pdf_filename,
-                    "compressed": os.path.basename(result["path"]),
-                    "stats": {
-                        "original_size": result["original_size"],
-                        "compressed_size": result["compressed_size"],
-                        "reduction": result["reduction"],
-                        "level": result.get("level", compression_level)
-                    }
-                }
-                
                 # Prepare the result message
                 if result["reduction"] > 0:
                     result_caption = (
                         f"Compressed PDF ({result.get('level', compression_level)} level): "
                         f"{result['reduction']:.1f}% reduction "
-                        f"({result['original_size']:.1f} KB → {result['compressed_size']:.1f} KB)"
+                        f"({format_file_size(result['original_size'] * 1024)} → {format_file_size(result['compressed_size'] * 1024)})"
                     )
                 else:
                     result_caption = (
                         f"Compression not beneficial for this PDF. "
-                        f"Original file returned ({result['original_size']:.1f} KB)."
+                        f"Original file returned ({format_file_size(result['original_size'] * 1024)})."
                     )
                 
                 # Send the compressed PDF
@@ -898,16 +895,16 @@ class WorkflowManager:
                 
                 if sent_id:
                     # Remove the processed PDF from the list of files to compress
-                    del compress_files[last_received_message_id]
+                    compress_files[last_received_message_id].pending = False
+                    pending_ids.pop()
                     
                     # Check if there are more PDFs to compress
-                    if compress_files:
-                        next_pdf_id = next(reversed(compress_files))
-                        pdf_size = workflow_info.get("original_sizes", {}).get(next_pdf_id, 0)
+                    if pending_ids:
+                        pdf_size = compress_files[pending_ids[-1]].original_size
                         
                         self.whatsapp_client.send_text(
                             sender_jid,
-                            f"Send 'low', 'medium', 'high', 'max', or 'auto' to compress the next PDF ({pdf_size:.1f} KB), or 'done' to finish."
+                            CompressPdfWorkflow.NEXT_PDF_TEMPLATE.format(size=format_file_size(pdf_size * 1024))
                         )
                     else:
                         self.whatsapp_client.send_text(
@@ -922,10 +919,9 @@ class WorkflowManager:
                 )
         else:
             # Invalid compression level
-            levels_str = ", ".join(f"'{level}'" for level in CompressPdfWorkflow.COMPRESSION_LEVELS.keys())
             self.whatsapp_client.send_text(
                 sender_jid,
-                f"Invalid compression level. Please send {levels_str}, or 'auto' for automatic level selection."
+                CompressPdfWorkflow.INVALID_LEVEL_MESSAGE
             )
 
     def handle_markdown_to_pdf_workflow(self, sender_jid, message_text, message_id=None):
@@ -1009,6 +1005,68 @@ class WorkflowManager:
             if success and message:
                 self.whatsapp_client.send_text(sender_jid, message)
 
+    def dispatch_message(self, message_data):
+        """
+        Queue an incoming message for processing without blocking the caller.
+        
+        Args:
+            message_data (dict): The message data
+        """
+        sender_jid = message_data.get('data', {}).get('key', {}).get('remoteJid')
+        if not sender_jid:
+            self.handle_message(message_data)
+            return
+        
+        with self._queue_lock:
+            queue = self._sender_queues.get(sender_jid)
+            if queue is not None:
+                # A worker is already draining this sender's queue
+                queue.append(message_data)
+                return
+            self._sender_queues[sender_jid] = deque([message_data])
+        
+        self._executor.submit(self._drain_sender_queue, sender_jid)
+    
+    def _drain_sender_queue(self, sender_jid):
+        """
+        Process queued messages for one sender in arrival order.
+        
+        Args:
+            sender_jid (str): The user's JID
+        """
+        while True:
+            with self._queue_lock:
+                queue = self._sender_queues[sender_jid]
+                if not queue:
+                    del self._sender_queues[sender_jid]
+                    return
+                message_data = queue.popleft()
+            
+            self.handle_message(message_data)
+    
+    def shutdown(self):
+        """
+        Stop accepting messages, wait for queued ones to finish, then close the
+        rendering browsers and the LibreOffice daemon.
+        """
+        if MarkdownToPdfWorkflow.has_open_browsers():
+            # Playwright objects can only be closed by the thread that started them,
+            # so one close task is held on every worker thread at the same time
+            barrier = threading.Barrier(MESSAGE_WORKERS)
+            
+            def close_on_worker():
+                try:
+                    barrier.wait(timeout=BROWSER_CLOSE_TIMEOUT)
+                except threading.BrokenBarrierError:
+                    pass
+                MarkdownToPdfWorkflow.close_thread_browser()
+            
+            for _ in range(MESSAGE_WORKERS):
+                self._executor.submit(close_on_worker)
+        
+        self._executor.shutdown(wait=True)
+        ExcelToPdfWorkflow.stop_libreoffice_daemon()
+    
     def handle_message(self, message_data):
         """
         Main handler for incoming messages.
@@ -1048,39 +1106,9 @@ class WorkflowManager:
             
             # Handle workflow start commands
             if message_text and not is_in_workflow:
-                command = message_text.lower()
-                
-                if command == 'merge pdf':
-                    self.start_workflow(sender_jid, "merge")
-                    return
-                    
-                elif command == 'split pdf':
-                    self.start_workflow(sender_jid, "split")
-                    return
-                    
-                elif command == 'scan document':
-                    self.start_workflow(sender_jid, "scan")
-                    return
-
-                elif command == 'word to pdf':
-                    self.start_workflow(sender_jid, "word_to_pdf")
-                    return
-
-                elif command == 'powerpoint to pdf':
-                    self.start_workflow(sender_jid, "powerpoint_to_pdf")
-                    return
-
-                elif command == 'excel to pdf':
-                    self.start_workflow(sender_jid, "excel_to_pdf")
-                    return
-
-                elif command == 'compress pdf':
-                    self.start_workflow(sender_jid, "compress")
-                    return
-
-                elif command in ['markdown to pdf', 'markdown2 to pdf']:
-                    # Both commands now use the same consolidated workflow
-                    self.start_workflow(sender_jid, "markdown_to_pdf")
+                workflow_type = START_COMMANDS.get(message_text.lower())
+                if workflow_type:
+                    self.start_workflow(sender_jid, workflow_type)
                     return
             
             # Handle active workflow interactions
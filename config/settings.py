@@ -20,6 +20,15 @@ LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 LOG_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'  # Simplified format
 
 # --- Processing Configuration ---
+# Number of users whose messages (and conversions) are processed concurrently
+MESSAGE_WORKERS = int(os.getenv('MESSAGE_WORKERS', '4'))
+# Ports of the LibreOffice daemon used for spreadsheet conversion; give each
+# bot instance on a host its own pair
+UNOSERVER_PORT = int(os.getenv('UNOSERVER_PORT', '2003'))
+UNOSERVER_UNO_PORT = int(os.getenv('UNOSERVER_UNO_PORT', '2002'))
+# Whether pypdf merges copy only pages, skipping form fields and named destinations
+MERGE_FAST_CONCAT = os.getenv('MERGE_FAST_CONCAT', 'true').lower() == 'true'
+
 SCAN_VERSIONS = [
     {'name': 'original', 'suffix': ''},
     {'name': 'bw', 'suffix': '_BW'},
@@ -1,6 +1,7 @@
 from Structure.model.Detector import GetModel
 import numpy as np
 import torch
+import cv2
 
 
 class Scanner:
@@ -34,7 +35,6 @@ class Scanner:
         return np.where(mask > (mask.mean() + abs(mask.std() / 2)), 255, 0).astype("uint8")
 
     def get_corners(self, img_path):
-        import cv2
         img = cv2.imread(img_path, 0)  # Read as grayscale
         mask = self.ScanView(img)
         
@@ -464,8 +464,6 @@ class DocScanner(object):
         except Exception as e:
             print(f"Error in processing: {e}")
 
-        from Utils import EnhancePaper
-
         # VARIANT 1: Direct approach - always use warped image
         paper_bw_direct = EnhancePaper(warped)
         filename_base, filename_ext = os.path.splitext(basename)
@@ -568,7 +566,8 @@ if __name__ == "__main__":
     elif im_dir:
         if os.path.isdir(im_dir):
             print(f"\nScanning images in directory: {im_dir}")
-            im_files = [f for f in os.listdir(im_dir) if os.path.isfile(os.path.join(im_dir, f)) and get_ext(f) in valid_formats]
+            with os.scandir(im_dir) as entries:
+                im_files = [entry.name for entry in entries if get_ext(entry.name) in valid_formats and entry.is_file()]
             if not im_files:
                 print(f"No valid images found in directory: {im_dir}")
             else:
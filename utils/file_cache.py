@@ -0,0 +1,145 @@
+"""
+Content-keyed result file cache for the Document Scanner application.
+"""
+
+import os
+import shutil
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+def _copy_replace(src, dst):
+    """
+    Copies src to a temporary file beside dst and swaps it into place, so
+    dst never shares an inode with src and is never seen half-written.
+
+    Args:
+        src (str): Existing file
+        dst (str): Path to create or replace
+    """
+    temp_path = f"{dst}.tmp"
+    try:
+        shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+class FileCache:
+    """
+    Stores result files under a content key, evicting the least recently used
+    entries once the total size exceeds a byte budget. Entries are copied in
+    and out of the cache directory rather than hardlinked, since workflows
+    rewrite their output paths in place and would overwrite a shared inode.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        """
+        Initialize the cache. The cache directory is only created and indexed
+        on first use, so importing a workflow does not touch the filesystem.
+
+        Args:
+            cache_dir (str): Directory holding the cached files
+            max_bytes (int): Total size budget for cached files
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> size in bytes, oldest first
+        self._total_bytes = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Indexes any entries left from a previous run, once. Caller holds the lock."""
+        if self._loaded:
+            return
+        self._loaded = True
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            existing = sorted(os.scandir(self.cache_dir), key=lambda entry: entry.stat().st_mtime)
+            for entry in existing:
+                if entry.name.endswith(".tmp"):
+                    os.remove(entry.path)  # Left by a copy interrupted mid-write
+                elif entry.is_file():
+                    size = entry.stat().st_size
+                    self._entries[entry.name] = size
+                    self._total_bytes += size
+            self._evict()
+        except OSError as e:
+            logger.warning(f"Could not index file cache {self.cache_dir}: {str(e)}")
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _evict(self):
+        """Drops the oldest entries until the cache fits its budget. Caller holds the lock."""
+        while self._entries and self._total_bytes > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def __contains__(self, key):
+        with self._lock:
+            self._load()
+            return key in self._entries
+
+    def get(self, key, dest_path):
+        """
+        Places the cached file for key at dest_path.
+
+        Args:
+            key (str): Cache key
+            dest_path (str): Path to create; replaced if it exists
+
+        Returns:
+            bool: True on a cache hit, False otherwise
+        """
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return False
+            self._entries.move_to_end(key)
+
+            try:
+                _copy_replace(self._path(key), dest_path)
+                return True
+            except OSError as e:
+                logger.warning(f"File cache read failed for {key}: {str(e)}")
+                self._total_bytes -= self._entries.pop(key)
+                return False
+
+    def put(self, key, src_path):
+        """
+        Stores a copy of src_path under key.
+
+        Args:
+            key (str): Cache key
+            src_path (str): File to cache
+        """
+        with self._lock:
+            self._load()
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+
+            try:
+                size = os.stat(src_path).st_size
+                if size > self.max_bytes:
+                    return
+                _copy_replace(src_path, self._path(key))
+            except OSError as e:
+                logger.warning(f"File cache write failed for {key}: {str(e)}")
+                return
+
+            self._entries[key] = size
+            self._total_bytes += size
+            self._evict()
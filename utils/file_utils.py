@@ -3,51 +3,78 @@ File utility functions for the Document Scanner application.
 """
 
 import os
-import json
+import errno
 import shutil
+import hashlib
 import logging
+import mimetypes
+from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
-def read_order_file(task_dir):
+@dataclass(slots=True)
+class ConvertedDocument:
+    """A document received in a conversion workflow, keyed by message ID."""
+    
+    original_name: str = None  # Filename as sent by the user
+    original: str = None  # Saved filename in the task directory
+    pdf: str = None  # Converted PDF filename
+
+def is_nonempty_file(path):
     """
-    Reads the merge_order.json file.
+    Checks that a path exists and has content, with a single stat call.
     
     Args:
-        task_dir (str): Path to the task directory
+        path (str): Path to check
         
     Returns:
-        dict: Order data from the file, or empty dict if file doesn't exist
+        bool: True if the path exists and is not empty
     """
-    order_file_path = os.path.join(task_dir, "merge_order.json")
     try:
-        if os.path.exists(order_file_path):
-            with open(order_file_path, 'r') as f:
-                return json.load(f)
-        return {}
-    except Exception as e:
-        logger.error(f"Error reading merge order file {order_file_path}: {str(e)}")
-        return {}
+        return os.stat(path).st_size > 0
+    except OSError:
+        return False
 
-def write_order_file(task_dir, order_data):
+def reorder(order_data, target_filename, new_order):
     """
-    Writes data to the merge_order.json file.
+    Builds a new order map with one file moved to a given position. The other
+    files are renumbered from 1 in their current order, skipping that position.
     
     Args:
-        task_dir (str): Path to the task directory
-        order_data (dict): Data to write to the file
+        order_data (dict): Dictionary mapping filenames to their order
+        target_filename (str): Filename to move
+        new_order (int): New position for the file
         
     Returns:
-        bool: True if successful, False if failed
+        dict: The new order map
+    """
+    other_files = sorted((fn for fn in order_data if fn != target_filename), key=order_data.get)
+    new_order_map = {target_filename: new_order}
+    sequence_num = 1
+    for filename in other_files:
+        if sequence_num == new_order:
+            sequence_num += 1
+        new_order_map[filename] = sequence_num
+        sequence_num += 1
+    return new_order_map
+
+def _move_file(src, dst):
+    """
+    Moves a file with a rename, falling back to a kernel-side copy when the
+    destination is on another filesystem.
+    
+    Args:
+        src (str): Source path
+        dst (str): Destination path
     """
-    order_file_path = os.path.join(task_dir, "merge_order.json")
     try:
-        with open(order_file_path, 'w') as f:
-            json.dump(order_data, f, indent=4)
-        return True
-    except Exception as e:
-        logger.error(f"Error writing merge order file {order_file_path}: {str(e)}")
-        return False
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # copyfile uses sendfile/copy_file_range, so the bytes stay in the kernel
+        shutil.copyfile(src, dst)
+        os.remove(src)
 
 def cleanup_task_universal(task_dir, source_files, output_files):
     """
@@ -68,12 +95,16 @@ def cleanup_task_universal(task_dir, source_files, output_files):
     try:
         os.makedirs(all_media_dir, exist_ok=True)
 
-        # Move source files
+        # Move source files, leaving any that were also sent back as outputs
+        # to be moved under their sent name below
+        output_paths = {os.path.abspath(output["path"]) for output in output_files}
         for filename in source_files:
             src = os.path.join(task_dir, filename)
+            if os.path.abspath(src) in output_paths:
+                continue
             dst = os.path.join(all_media_dir, filename)
             if os.path.exists(src):
-                shutil.move(src, dst)
+                _move_file(src, dst)
                 moved_count += 1
 
         # Move output files
@@ -82,7 +113,7 @@ def cleanup_task_universal(task_dir, source_files, output_files):
             filename = f"{output.get('sent_id', os.path.basename(src))}.pdf"
             dst = os.path.join(all_media_dir, filename)
             if os.path.exists(src):
-                shutil.move(src, dst)
+                _move_file(src, dst)
                 moved_count += 1
 
         # Remove task directory
@@ -105,11 +136,52 @@ def get_file_extension_from_mimetype(mimetype):
     Returns:
         str: File extension including the dot
     """
-    import mimetypes
-    
     if not mimetype:
         return '.bin'
     if mimetype == 'application/pdf':
         return '.pdf'
     guess = mimetypes.guess_extension(mimetype)
     return guess or '.bin'
+
+def get_file_hash(file_path):
+    """
+    Computes the SHA-256 digest of a file's content.
+    
+    Args:
+        file_path (str): Path to the file
+        
+    Returns:
+        str: Hex digest of the file content
+    """
+    with open(file_path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(f, 'sha256').hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+FILE_SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+def format_file_size(size_bytes):
+    """
+    Formats a byte count as a human-readable size string.
+    
+    Args:
+        size_bytes (int): Size in bytes
+        
+    Returns:
+        str: Formatted size, e.g. "1.5 MB"
+    """
+    size_bytes = int(size_bytes)
+    if size_bytes <= 0:
+        return "0 B"
+    # bit_length gives floor(log2) directly, so the unit is a single lookup
+    unit_index = min(len(FILE_SIZE_UNITS) - 1, (size_bytes.bit_length() - 1) // 10)
+    if not unit_index:
+        return f"{size_bytes} B"
+    # Integer shifts give the whole units and the truncated tenth without floats
+    shift = unit_index * 10
+    whole = size_bytes >> shift
+    tenth = ((size_bytes & ((1 << shift) - 1)) * 10) >> shift
+    return f"{whole}.{tenth} {FILE_SIZE_UNITS[unit_index]}"
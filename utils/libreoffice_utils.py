@@ -0,0 +1,88 @@
+"""
+LibreOffice utility functions for the Document Scanner application.
+"""
+
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from config.settings import MESSAGE_WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Reused LibreOffice profiles, grouped by registry content
+LIBREOFFICE_PROFILE_ROOT = os.path.join(tempfile.gettempdir(), "file-bot", "lo_profiles")
+
+# Profiles per registry content: one per message worker, so concurrent
+# conversions only wait on each other when every profile is in use
+LIBREOFFICE_PROFILE_SLOTS = MESSAGE_WORKERS
+
+def _prepare_profile(profile_dir, registry):
+    """
+    Create a profile directory, seeding its registry on first use.
+    LibreOffice initialises the rest of the profile on its first run.
+
+    Args:
+        profile_dir (str): Path to the profile directory
+        registry (str): registrymodifications.xcu content, or None for defaults
+    """
+    if registry is None:
+        os.makedirs(profile_dir, exist_ok=True)
+        return
+
+    # LibreOffice reads the registry from the profile's user directory
+    registry_dir = os.path.join(profile_dir, "user")
+    registry_path = os.path.join(registry_dir, "registrymodifications.xcu")
+    if not os.path.exists(registry_path):
+        os.makedirs(registry_dir, exist_ok=True)
+        temp_path = f"{registry_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(registry)
+        os.replace(temp_path, registry_path)
+
+@contextmanager
+def libreoffice_profile(registry=None):
+    """
+    Lease a LibreOffice user profile for one conversion. A second instance
+    started on a profile that is in use exits without converting, so each
+    profile is guarded by a file lock across threads and processes. A free
+    profile is taken when there is one; otherwise the caller waits for the
+    first.
+
+    Args:
+        registry (str): registrymodifications.xcu content for the profile,
+            or None for LibreOffice's defaults
+
+    Yields:
+        str: The -env:UserInstallation argument for the leased profile
+    """
+    profile_key = hashlib.sha1((registry or "").encode("utf-8")).hexdigest()
+    base_dir = os.path.join(LIBREOFFICE_PROFILE_ROOT, profile_key)
+    os.makedirs(base_dir, exist_ok=True)
+
+    lock_file = None
+    slot = 0
+    for candidate_slot in range(LIBREOFFICE_PROFILE_SLOTS):
+        candidate = open(os.path.join(base_dir, f"{candidate_slot}.lock"), "w")
+        try:
+            fcntl.flock(candidate, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            candidate.close()
+            continue
+        lock_file, slot = candidate, candidate_slot
+        break
+
+    if lock_file is None:
+        logger.info("All LibreOffice profiles are in use, waiting for one")
+        lock_file = open(os.path.join(base_dir, "0.lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+    try:
+        profile_dir = os.path.join(base_dir, str(slot))
+        _prepare_profile(profile_dir, registry)
+        yield f"-env:UserInstallation=file://{profile_dir}"
+    finally:
+        lock_file.close()
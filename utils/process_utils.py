@@ -0,0 +1,80 @@
+"""
+Subprocess utility functions for the Document Scanner application.
+"""
+
+import logging
+import threading
+import subprocess
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Number of trailing stderr lines kept for error reporting
+STDERR_TAIL_LINES = 50
+
+def _drain_stderr(stream, tail, log_prefix):
+    """
+    Reads a process's stderr line by line into the log, keeping only the tail.
+
+    Args:
+        stream: The process's stderr pipe
+        tail (deque): Bounded buffer receiving the most recent lines
+        log_prefix (str): Prefix for each logged line
+    """
+    with stream:
+        for line in stream:
+            line = line.rstrip()
+            if line:
+                tail.append(line)
+                logger.debug(f"{log_prefix}: {line}")
+
+def run_command(cmd, timeout=None, check=False, log_prefix=None):
+    """
+    Runs a command without buffering its output in memory. stdout is discarded
+    and stderr is streamed to the log, with only the last lines retained.
+
+    Args:
+        cmd (list): Command and arguments
+        timeout (float): Seconds to wait before killing the process
+        check (bool): Whether to raise CalledProcessError on a non-zero exit
+        log_prefix (str): Prefix for logged stderr lines, defaults to the program name
+
+    Returns:
+        tuple: (returncode, stderr_tail) - Exit code and the last stderr lines
+
+    Raises:
+        subprocess.TimeoutExpired: If the process exceeds the timeout
+        subprocess.CalledProcessError: If check is set and the process failed
+    """
+    tail = deque(maxlen=STDERR_TAIL_LINES)
+    process = subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace"
+    )
+
+    reader = threading.Thread(
+        target=_drain_stderr,
+        args=(process.stderr, tail, log_prefix or cmd[0]),
+        daemon=True
+    )
+    reader.start()
+
+    try:
+        returncode = process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        reader.join()
+        raise
+
+    reader.join()
+    stderr_tail = "\n".join(tail)
+
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr_tail)
+
+    return returncode, stderr_tail
@@ -3,13 +3,99 @@ Workflow for compressing PDF files to reduce file size while maintaining quality
 """
 
 import os
+import hashlib
 import logging
+import tempfile
 import subprocess
-from utils.file_utils import read_order_file
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from pypdf import PdfReader, PdfWriter
+from utils.file_utils import get_file_hash, format_file_size, is_nonempty_file
+from utils.process_utils import run_command
+from utils.file_cache import FileCache
 
 # Initialize logger
 logger = logging.getLogger(__name__)
 
+def _ps_string(value):
+    """Quote a value as a PostScript string literal."""
+    escaped = value.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return f"({escaped})"
+
+# Ghostscript processes run at once by a batch; pdfwrite is single-threaded,
+# so batches fan out across cores
+GS_BATCH_WORKERS = os.cpu_count() or 1
+
+def _build_gs_options(level_settings):
+    """
+    Build the Ghostscript options for one compression level's settings.
+    
+    Args:
+        level_settings (dict): Entry from CompressPdfWorkflow.COMPRESSION_LEVELS
+        
+    Returns:
+        tuple: (options, distiller_params) - gs flags without input/output
+            and the PostScript that tunes the DCT encoder
+    """
+    dpi = level_settings["dpi"]
+    quality = level_settings["quality"]
+    
+    # pdfwrite ignores -dJPEGQ for embedded images; its DCT encoder is tuned
+    # through the distiller image dictionaries instead (QFactor and chroma
+    # subsampling), so pass those per level
+    qfactor = level_settings["qfactor"]
+    samples = "[2 1 1 2]" if level_settings["chroma_subsampling"] else "[1 1 1 1]"
+    color_dict = f"<< /QFactor {qfactor} /Blend 1 /HSamples {samples} /VSamples {samples} >>"
+    gray_dict = f"<< /QFactor {qfactor} /Blend 1 /HSamples [1 1 1 1] /VSamples [1 1 1 1] >>"
+    distiller_params = (
+        f"<< /ColorACSImageDict {color_dict} /ColorImageDict {color_dict} "
+        f"/GrayACSImageDict {gray_dict} /GrayImageDict {gray_dict} >> setdistillerparams"
+    )
+    
+    # Explicit settings only: a -dPDFSETTINGS preset would supply its own
+    # image filters and thresholds, and downsampling is off by default
+    # without one, so every image knob is spelled out here
+    options = [
+        "-sDEVICE=pdfwrite",
+        "-dCompatibilityLevel=1.4",
+        "-dDownsampleColorImages=true",
+        "-dDownsampleGrayImages=true",
+        "-dDownsampleMonoImages=true",
+        "-dAutoFilterColorImages=false",
+        "-dColorImageFilter=/DCTEncode",
+        "-dAutoFilterGrayImages=false",
+        "-dGrayImageFilter=/DCTEncode",
+        f"-dColorImageResolution={dpi}",
+        f"-dGrayImageResolution={dpi}",
+        f"-dMonoImageResolution={dpi}",
+        f"-dColorImageDownsampleType=/Bicubic",
+        f"-dColorImageDownsampleThreshold=1.0",
+        f"-dGrayImageDownsampleType=/Bicubic",
+        f"-dGrayImageDownsampleThreshold=1.0",
+        f"-dMonoImageDownsampleType=/Bicubic",
+        f"-dMonoImageDownsampleThreshold=1.0",
+        f"-dJPEGQ={quality}",
+        "-dNOPAUSE",
+        "-dQUIET",
+        "-dBATCH"
+    ]
+    
+    return tuple(options), distiller_params
+
+@dataclass(slots=True)
+class CompressFile:
+    """State of one PDF received in a compress workflow."""
+    
+    saved_filename: str
+    input_path: str
+    output_path: str
+    file_hash: str
+    original_size: float = 0  # KB
+    pending: bool = True  # Not yet sent back to the user
+    compressed_filename: str = None
+    stats: dict = None
+
 class CompressPdfWorkflow:
     """Handles PDF file compression."""
     
@@ -20,6 +106,8 @@ class CompressPdfWorkflow:
             "color_profile": "sRGB",
             "colorspace": "srgb",
             "quality": 90,
+            "qfactor": 0.4,
+            "chroma_subsampling": False,
             "description": "Low compression (good quality, moderate size reduction)"
         },
         "medium": {
@@ -27,6 +115,8 @@ class CompressPdfWorkflow:
             "color_profile": "sRGB",
             "colorspace": "srgb", 
             "quality": 80,
+            "qfactor": 0.76,
+            "chroma_subsampling": True,
             "description": "Medium compression (balanced quality and size)"
         },
         "high": {
@@ -34,6 +124,8 @@ class CompressPdfWorkflow:
             "color_profile": "sRGB",
             "colorspace": "srgb",
             "quality": 70,
+            "qfactor": 1.0,
+            "chroma_subsampling": True,
             "description": "High compression (smaller file size, adequate quality)"
         },
         "max": {
@@ -41,10 +133,52 @@ class CompressPdfWorkflow:
             "color_profile": "sRGB", 
             "colorspace": "srgb",
             "quality": 60,
+            "qfactor": 1.3,
+            "chroma_subsampling": True,
             "description": "Maximum compression (smallest file size, lower quality)"
         }
     }
     
+    # Ghostscript options per level, built once at class load
+    GS_OPTIONS_BY_LEVEL = {
+        level: _build_gs_options(settings) for level, settings in COMPRESSION_LEVELS.items()
+    }
+    
+    # Compressed outputs keyed by input content and level, so re-sent or
+    # forwarded PDFs skip compression entirely
+    RESULT_CACHE = FileCache(
+        os.path.join(tempfile.gettempdir(), "file-bot", "compress_cache"),
+        1 << 30  # 1 GiB
+    )
+    
+    # Levels whose images are re-encoded in-process before falling back to Ghostscript
+    IN_PROCESS_LEVELS = ("high", "max")
+    
+    # Bumped whenever the compression code changes its output for the same settings
+    RESULT_CACHE_VERSION = 1
+    
+    # Digest of the version and settings results are produced with; RESULT_CACHE
+    # outlives restarts, so results made with other settings must not be reused
+    RESULT_CACHE_TAG = hashlib.sha256(
+        repr((RESULT_CACHE_VERSION, COMPRESSION_LEVELS, GS_OPTIONS_BY_LEVEL, IN_PROCESS_LEVELS)).encode("utf-8")
+    ).hexdigest()[:16]
+    
+    # Ghostscript processes run at once by compress_batch
+    BATCH_WORKERS = GS_BATCH_WORKERS
+    
+    # User-facing level prompts, resolved once at class load instead of per message
+    LEVEL_CHOICES = ", ".join(f"'{level}'" for level in COMPRESSION_LEVELS)
+    PDF_RECEIVED_TEMPLATE = (
+        "PDF received: {filename} ({size}). "
+        "Send " + LEVEL_CHOICES + " to set compression level, or 'auto' for automatic compression."
+    )
+    NEXT_PDF_TEMPLATE = (
+        "Send " + LEVEL_CHOICES + ", or 'auto' to compress the next PDF ({size}), or 'done' to finish."
+    )
+    INVALID_LEVEL_MESSAGE = (
+        "Invalid compression level. Please send " + LEVEL_CHOICES + ", or 'auto' for automatic level selection."
+    )
+    
     @staticmethod
     def handle_pdf_save(task_dir, message_id, saved_filename, workflow_info=None):
         """
@@ -64,24 +198,256 @@ class CompressPdfWorkflow:
             
         pdf_file_path = os.path.join(task_dir, saved_filename)
         
-        if not os.path.exists(pdf_file_path):
+        try:
+            file_size = os.stat(pdf_file_path).st_size
+        except OSError:
             return None, "Error: PDF file not found."
             
-        # Store info about this PDF in the workflow
-        if "compress_files" not in workflow_info:
-            workflow_info["compress_files"] = {}
+        compress_files = workflow_info.setdefault("compress_files", {})
+        
+        # Drop re-sent copies of a PDF that is still waiting for a compression level
+        file_hash = get_file_hash(pdf_file_path)
+        if any(entry.pending and entry.file_hash == file_hash for entry in compress_files.values()):
+            os.remove(pdf_file_path)
+            return None, "This PDF was already received and is waiting for a compression level."
+        
+        # Resolve input/output paths and the original size once per PDF
+        file_base, file_ext = os.path.splitext(saved_filename)
+        file_size_kb = file_size / 1024
+        compress_files[message_id] = CompressFile(
+            saved_filename=saved_filename,
+            input_path=pdf_file_path,
+            output_path=os.path.join(task_dir, f"{file_base}_compressed{file_ext}"),
+            file_hash=file_hash,
+            original_size=file_size_kb
+        )
+        
+        return saved_filename, CompressPdfWorkflow.PDF_RECEIVED_TEMPLATE.format(
+            filename=saved_filename,
+            size=format_file_size(file_size_kb * 1024)
+        )
+    
+    @staticmethod
+    def recompress_images(input_path, output_path, jpeg_quality, target_dpi=None):
+        """
+        Re-encode the embedded JPEG images of a PDF in-process, leaving text
+        and vector content untouched. Images above the target resolution are
+        downsampled first, estimating their resolution against the page size.
+        
+        Args:
+            input_path (str): Path to input PDF
+            output_path (str): Path to save the re-encoded PDF
+            jpeg_quality (int): JPEG quality for the re-encoded images
+            target_dpi (int): Resolution to downsample larger images to
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            writer = PdfWriter(clone_from=input_path)
+            seen_images = set()
+            
+            for page in writer.pages:
+                page_width_in = float(page.mediabox.width) / 72 or 1
+                page_height_in = float(page.mediabox.height) / 72 or 1
+                
+                for image in page.images:
+                    ref = image.indirect_reference
+                    # Inline images cannot be replaced; shared images are re-encoded once
+                    if ref is None or (ref.idnum, ref.generation) in seen_images:
+                        continue
+                    seen_images.add((ref.idnum, ref.generation))
+                    
+                    # Only existing JPEGs are re-encoded; lossless images are left alone
+                    if not image.name.lower().endswith((".jpg", ".jpeg")):
+                        continue
+                    pil_image = image.image
+                    if pil_image.mode not in ("RGB", "L"):
+                        continue
+                    
+                    if target_dpi:
+                        image_dpi = max(
+                            pil_image.width / page_width_in,
+                            pil_image.height / page_height_in
+                        )
+                        if image_dpi > target_dpi:
+                            scale = target_dpi / image_dpi
+                            pil_image = pil_image.resize(
+                                (max(1, round(pil_image.width * scale)), max(1, round(pil_image.height * scale))),
+                                Image.LANCZOS
+                            )
+                    
+                    image.replace(pil_image, quality=jpeg_quality)
+            
+            with open(output_path, "wb") as f_out:
+                writer.write(f_out)
+            
+            return os.path.exists(output_path)
+            
+        except Exception as e:
+            logger.error(f"Error re-encoding PDF images: {str(e)}")
+            return False
+    
+    @staticmethod
+    def max_image_dpi(input_path, stop_above=None):
+        """
+        Estimate the highest resolution of the images embedded in a PDF,
+        including images nested inside form XObjects. Each image is assumed to
+        span its page, so the estimate is its pixel size over the MediaBox size.
+        
+        Args:
+            input_path (str): Path to input PDF
+            stop_above (float): Return as soon as an image exceeds this DPI
+            
+        Returns:
+            float: Highest estimated DPI, 0 if there are no images, or infinity
+                if the PDF could not be inspected
+        """
+        try:
+            reader = PdfReader(input_path)
+            max_dpi = 0
+            
+            for page in reader.pages:
+                page_width_in = float(page.mediabox.width) / 72 or 1
+                page_height_in = float(page.mediabox.height) / 72 or 1
+                seen_forms = set()
+                pending = [page.get("/Resources")]
+                
+                while pending:
+                    resources = pending.pop()
+                    if resources is None:
+                        continue
+                    xobjects = resources.get_object().get("/XObject")
+                    if xobjects is None:
+                        continue
+                    for xobject_ref in xobjects.get_object().values():
+                        xobject = xobject_ref.get_object()
+                        subtype = xobject.get("/Subtype")
+                        if subtype == "/Image":
+                            image_dpi = max(
+                                float(xobject.get("/Width", 0)) / page_width_in,
+                                float(xobject.get("/Height", 0)) / page_height_in
+                            )
+                            max_dpi = max(max_dpi, image_dpi)
+                            if stop_above is not None and max_dpi > stop_above:
+                                return max_dpi
+                        elif subtype == "/Form":
+                            ref = getattr(xobject_ref, "idnum", None)
+                            if ref is not None and ref in seen_forms:
+                                continue
+                            seen_forms.add(ref)
+                            pending.append(xobject.get("/Resources"))
+            
+            return max_dpi
+            
+        except Exception as e:
+            logger.error(f"Error inspecting PDF images: {str(e)}")
+            return float("inf")
+    
+    @staticmethod
+    def rewrite_lossless(input_path, output_path):
+        """
+        Rewrite a PDF without touching its content: compress content streams
+        and drop duplicate and unreferenced objects.
+        
+        Args:
+            input_path (str): Path to input PDF
+            output_path (str): Path to save the rewritten PDF
+            
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        try:
+            writer = PdfWriter(clone_from=input_path)
+            for page in writer.pages:
+                page.compress_content_streams()
+            if hasattr(writer, "compress_identical_objects"):
+                writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+            
+            with open(output_path, "wb") as f_out:
+                writer.write(f_out)
+            
+            return os.path.exists(output_path)
+            
+        except Exception as e:
+            logger.error(f"Error rewriting PDF: {str(e)}")
+            return False
+    
+    @staticmethod
+    def build_gs_options(compression_level, concurrency=1):
+        """
+        Get the Ghostscript options for a compression level.
+        
+        Args:
+            compression_level (str): Compression level (low, medium, high, max)
+            concurrency (int): Ghostscript processes sharing the cores with this one
             
-        workflow_info["compress_files"][message_id] = saved_filename
+        Returns:
+            tuple: (options, distiller_params) - gs flags without input/output
+                and the PostScript that tunes the DCT encoder
+        """
+        options, distiller_params = CompressPdfWorkflow.GS_OPTIONS_BY_LEVEL.get(
+            compression_level,
+            CompressPdfWorkflow.GS_OPTIONS_BY_LEVEL["medium"]
+        )
         
-        # Get original file size for later comparison
-        file_size_kb = os.path.getsize(pdf_file_path) / 1024
-        workflow_info["original_sizes"] = workflow_info.get("original_sizes", {})
-        workflow_info["original_sizes"][message_id] = file_size_kb
+        # Split the cores between the processes running at once, so a lone
+        # file gets all of them and batch workers do not oversubscribe
+        rendering_threads = max(1, (os.cpu_count() or 1) // concurrency)
+        return (*options, f"-dNumRenderingThreads={rendering_threads}"), distiller_params
+    
+    @staticmethod
+    def compress_pdf_group(jobs, compression_level="medium", concurrency=1):
+        """
+        Compress several PDFs with a single Ghostscript process, switching the
+        output file between inputs, so interpreter startup is paid once.
         
-        return saved_filename, f"PDF received: {saved_filename} ({file_size_kb:.1f} KB). Send 'low', 'medium', 'high', or 'max' to set compression level, or 'auto' for automatic compression."
+        Args:
+            jobs (list): (input_path, output_path) pairs
+            compression_level (str): Compression level shared by all jobs
+            concurrency (int): Groups being compressed at the same time
+            
+        Returns:
+            bool: True if every output was written, False otherwise
+        """
+        try:
+            gs_options, distiller_params = CompressPdfWorkflow.build_gs_options(compression_level, concurrency)
+            
+            program = [distiller_params]
+            permits = []
+            for input_path, output_path in jobs:
+                program.append(
+                    f"<< /OutputFile {_ps_string(output_path)} >> setpagedevice "
+                    f"{_ps_string(input_path)} run"
+                )
+                # SAFER only lets PostScript touch files named on the command line
+                permits.append(f"--permit-file-read={input_path}")
+                permits.append(f"--permit-file-write={output_path}")
+            
+            gs_command = [
+                "gs",
+                *gs_options,
+                *permits,
+                "-sOutputFile=" + jobs[0][1],
+                "-c", " ".join(program)
+            ]
+            
+            run_command(gs_command, check=True)
+            
+            return all(
+                is_nonempty_file(output_path)
+                for _, output_path in jobs
+            )
+            
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Ghostscript batch error: {e.stderr}")
+            return False
+        except Exception as e:
+            logger.error(f"Error compressing PDF batch: {str(e)}")
+            return False
     
     @staticmethod
-    def compress_pdf(input_path, output_path, compression_level="medium"):
+    def compress_pdf(input_path, output_path, compression_level="medium", max_dpi=None, concurrency=1):
         """
         Compress a PDF file using Ghostscript.
         
@@ -89,6 +455,8 @@ class CompressPdfWorkflow:
             input_path (str): Path to input PDF
             output_path (str): Path to save compressed PDF
             compression_level (str): Compression level (low, medium, high, max)
+            max_dpi (float): max_image_dpi of the input for this level, computed here when not given
+            concurrency (int): Files being compressed at the same time
             
         Returns:
             bool: True if successful, False otherwise
@@ -99,39 +467,39 @@ class CompressPdfWorkflow:
                 compression_level, 
                 CompressPdfWorkflow.COMPRESSION_LEVELS["medium"]
             )
-            
             dpi = level_settings["dpi"]
             quality = level_settings["quality"]
             
+            # Text/vector-only PDFs, and PDFs whose images are already at or below
+            # the target resolution, have nothing for Ghostscript to downsample, so
+            # rewrite them losslessly. High and max still re-encode existing images.
+            if max_dpi is None:
+                max_dpi = CompressPdfWorkflow.max_image_dpi(input_path, stop_above=dpi)
+            if max_dpi == 0 or (max_dpi <= dpi and compression_level not in CompressPdfWorkflow.IN_PROCESS_LEVELS):
+                if CompressPdfWorkflow.rewrite_lossless(input_path, output_path):
+                    return True
+            
+            # High and max are dominated by image quality, so re-encode the images
+            # in-process first and only fall back to a full Ghostscript rewrite
+            if compression_level in CompressPdfWorkflow.IN_PROCESS_LEVELS and CompressPdfWorkflow.recompress_images(
+                input_path,
+                output_path,
+                quality,
+                target_dpi=dpi
+            ):
+                return True
+            
             # Use Ghostscript for PDF compression
+            gs_options, distiller_params = CompressPdfWorkflow.build_gs_options(compression_level, concurrency)
             gs_command = [
                 "gs",
-                "-sDEVICE=pdfwrite",
-                "-dCompatibilityLevel=1.4",
-                "-dPDFSETTINGS=/ebook",
-                f"-dColorImageResolution={dpi}",
-                f"-dGrayImageResolution={dpi}",
-                f"-dMonoImageResolution={dpi}",
-                f"-dColorImageDownsampleType=/Bicubic",
-                f"-dColorImageDownsampleThreshold=1.0",
-                f"-dGrayImageDownsampleType=/Bicubic",
-                f"-dGrayImageDownsampleThreshold=1.0",
-                f"-dMonoImageDownsampleType=/Bicubic",
-                f"-dMonoImageDownsampleThreshold=1.0",
-                f"-dJPEGQ={quality}",
-                "-dNOPAUSE",
-                "-dQUIET",
-                "-dBATCH",
+                *gs_options,
                 "-sOutputFile=" + output_path,
-                input_path
+                "-c", distiller_params,
+                "-f", input_path
             ]
             
-            process = subprocess.run(
-                gs_command, 
-                capture_output=True, 
-                text=True, 
-                check=True
-            )
+            run_command(gs_command, check=True)
             
             return os.path.exists(output_path)
             
@@ -154,11 +522,11 @@ class CompressPdfWorkflow:
         Returns:
             tuple: (original_size_kb, compressed_size_kb, reduction_percent)
         """
-        if not os.path.exists(original_path) or not os.path.exists(compressed_path):
+        try:
+            original_size = os.stat(original_path).st_size
+            compressed_size = os.stat(compressed_path).st_size
+        except OSError:
             return 0, 0, 0
-            
-        original_size = os.path.getsize(original_path)
-        compressed_size = os.path.getsize(compressed_path)
         
         original_size_kb = original_size / 1024
         compressed_size_kb = compressed_size / 1024
@@ -191,7 +559,23 @@ class CompressPdfWorkflow:
             return "max"
     
     @staticmethod
-    def compress_single_pdf(task_dir, pdf_filename, compression_level="medium", auto_level=False):
+    def result_cache_key(file_hash, compression_level):
+        """
+        Build the RESULT_CACHE key for an input and compression level, tagged
+        with the settings the result is produced with.
+        
+        Args:
+            file_hash (str): SHA-256 of the input PDF
+            compression_level (str): Compression level
+            
+        Returns:
+            str: Cache key
+        """
+        return f"{file_hash}-{compression_level}-{CompressPdfWorkflow.RESULT_CACHE_TAG}"
+    
+    @staticmethod
+    def compress_single_pdf(task_dir, pdf_filename, compression_level="medium", auto_level=False, paths=None,
+                            precompressed=False, file_hash=None, max_dpi=None, concurrency=1):
         """
         Compress a single PDF file.
         
@@ -200,33 +584,49 @@ class CompressPdfWorkflow:
             pdf_filename (str): PDF filename
             compression_level (str): Compression level
             auto_level (bool): Whether to automatically determine compression level
+            paths (tuple): Optional (input_path, output_path) resolved by handle_pdf_save
+            precompressed (bool): Whether the output was already written by compress_pdf_group
+            file_hash (str): SHA-256 of the input, computed here when not given
+            max_dpi (float): max_image_dpi of the input for compression_level, if known
+            concurrency (int): Files being compressed at the same time
             
         Returns:
             dict: Compression information
         """
-        input_path = os.path.join(task_dir, pdf_filename)
+        if paths:
+            input_path, output_path = paths
+        else:
+            input_path = os.path.join(task_dir, pdf_filename)
+            file_base, file_ext = os.path.splitext(pdf_filename)
+            output_path = os.path.join(task_dir, f"{file_base}_compressed{file_ext}")
         
-        if not os.path.exists(input_path):
+        try:
+            input_size = os.stat(input_path).st_size
+        except OSError:
             return {
                 "success": False,
                 "error": f"PDF file not found: {pdf_filename}"
             }
         
-        # Create output filename
-        file_base, file_ext = os.path.splitext(pdf_filename)
-        output_filename = f"{file_base}_compressed{file_ext}"
-        output_path = os.path.join(task_dir, output_filename)
-        
         # Determine compression level if auto
         if auto_level:
-            file_size_kb = os.path.getsize(input_path) / 1024
+            file_size_kb = input_size / 1024
             compression_level = CompressPdfWorkflow.determine_best_compression_level(file_size_kb)
+            max_dpi = None  # Measured against another level's resolution
+        
+        # Reuse an earlier result for the same content and level
+        if file_hash is None:
+            file_hash = get_file_hash(input_path)
+        cache_key = CompressPdfWorkflow.result_cache_key(file_hash, compression_level)
+        cached = not precompressed and CompressPdfWorkflow.RESULT_CACHE.get(cache_key, output_path)
         
         # Compress PDF
-        success = CompressPdfWorkflow.compress_pdf(
+        success = precompressed or cached or CompressPdfWorkflow.compress_pdf(
             input_path, 
             output_path, 
-            compression_level
+            compression_level,
+            max_dpi=max_dpi,
+            concurrency=concurrency
         )
         
         if not success:
@@ -243,16 +643,20 @@ class CompressPdfWorkflow:
         
         # If compressed file is larger, use the original
         if compressed_kb >= original_kb:
-            os.replace(input_path, output_path)
+            # Discard the larger output and hand back the original file itself
+            os.remove(output_path)
             return {
                 "success": True,
-                "path": output_path,
+                "path": input_path,
                 "original_size": original_kb,
                 "compressed_size": original_kb,
                 "reduction": 0,
                 "note": "Compression not beneficial - using original file"
             }
         
+        if not cached:
+            CompressPdfWorkflow.RESULT_CACHE.put(cache_key, output_path)
+        
         return {
             "success": True,
             "path": output_path,
@@ -260,4 +664,123 @@ class CompressPdfWorkflow:
             "compressed_size": compressed_kb,
             "reduction": reduction,
             "level": compression_level
-        }
\ No newline at end of file
+        }
+    
+    @staticmethod
+    def compress_and_record(workflow_info, message_id, compression_level="medium", auto_level=False,
+                            precompressed=False, max_dpi=None, concurrency=1):
+        """
+        Compress a received PDF and record the result in the workflow.
+        
+        Args:
+            workflow_info (dict): Workflow information
+            message_id (str): Message ID the PDF was received with
+            compression_level (str): Compression level
+            auto_level (bool): Whether to automatically determine compression level
+            precompressed (bool): Whether the output was already written by compress_pdf_group
+            max_dpi (float): max_image_dpi of the input for compression_level, if known
+            concurrency (int): Files being compressed at the same time
+            
+        Returns:
+            dict: Compression information from compress_single_pdf
+        """
+        entry = workflow_info["compress_files"][message_id]
+        result = CompressPdfWorkflow.compress_single_pdf(
+            workflow_info["task_dir"],
+            entry.saved_filename,
+            compression_level,
+            auto_level=auto_level,
+            paths=(entry.input_path, entry.output_path),
+            precompressed=precompressed,
+            file_hash=entry.file_hash,
+            max_dpi=max_dpi,
+            concurrency=concurrency
+        )
+        
+        if result["success"]:
+            entry.compressed_filename = os.path.basename(result["path"])
+            entry.stats = {
+                "original_size": result["original_size"],
+                "compressed_size": result["compressed_size"],
+                "reduction": result["reduction"],
+                "level": result.get("level", compression_level)
+            }
+        
+        return result
+    
+    @staticmethod
+    def compress_batch(workflow_info, message_ids, compression_level="medium"):
+        """
+        Compress several received PDFs concurrently and record the results.
+        
+        Args:
+            workflow_info (dict): Workflow information
+            message_ids (list): Message IDs of the PDFs to compress
+            compression_level (str): Compression level
+            
+        Returns:
+            dict: Compression information keyed by message ID, in the given order
+        """
+        if len(message_ids) <= 1:
+            return {
+                message_id: CompressPdfWorkflow.compress_and_record(workflow_info, message_id, compression_level)
+                for message_id in message_ids
+            }
+        
+        compress_files = workflow_info["compress_files"]
+        
+        # PDFs that will go through Ghostscript share one gs process per worker
+        # instead of paying interpreter startup for every file
+        # Image resolutions are measured once here and handed on to compress_pdf
+        group_ids = []
+        max_dpis = {}
+        if compression_level not in CompressPdfWorkflow.IN_PROCESS_LEVELS:
+            target_dpi = CompressPdfWorkflow.COMPRESSION_LEVELS.get(
+                compression_level,
+                CompressPdfWorkflow.COMPRESSION_LEVELS["medium"]
+            )["dpi"]
+            for message_id in message_ids:
+                entry = compress_files[message_id]
+                if CompressPdfWorkflow.result_cache_key(entry.file_hash, compression_level) in CompressPdfWorkflow.RESULT_CACHE:
+                    continue
+                max_dpis[message_id] = CompressPdfWorkflow.max_image_dpi(entry.input_path, stop_above=target_dpi)
+                if max_dpis[message_id] > target_dpi:
+                    group_ids.append(message_id)
+        
+        precompressed_ids = set()
+        if len(group_ids) > 1:
+            worker_count = min(len(group_ids), CompressPdfWorkflow.BATCH_WORKERS)
+            groups = [group_ids[i::worker_count] for i in range(worker_count)]
+            with ThreadPoolExecutor(max_workers=worker_count) as executor:
+                group_results = executor.map(
+                    lambda group: CompressPdfWorkflow.compress_pdf_group(
+                        [(compress_files[message_id].input_path, compress_files[message_id].output_path)
+                         for message_id in group],
+                        compression_level,
+                        concurrency=worker_count
+                    ),
+                    groups
+                )
+                for group, group_success in zip(groups, group_results):
+                    # Failed groups fall back to per-file compression below
+                    if group_success:
+                        precompressed_ids.update(group)
+        
+        # Each job spends its time in a Ghostscript subprocess or in pypdf's zlib
+        # calls, so threads are enough to keep several cores busy
+        max_workers = min(len(message_ids), CompressPdfWorkflow.BATCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                message_id: executor.submit(
+                    CompressPdfWorkflow.compress_and_record,
+                    workflow_info,
+                    message_id,
+                    compression_level,
+                    precompressed=message_id in precompressed_ids,
+                    max_dpi=max_dpis.get(message_id),
+                    concurrency=max_workers
+                )
+                for message_id in message_ids
+            }
+        
+        return {message_id: future.result() for message_id, future in futures.items()}
@@ -3,18 +3,349 @@ Excel to PDF conversion workflow handler for the Document Scanner application.
 """
 
 import os
+import csv
+import codecs
 import time
 import logging
 import subprocess
 import shutil
+import signal
+import socket
+import tempfile
+import threading
+from pypdf import PdfWriter
 
-from utils.file_utils import read_order_file, write_order_file
+# Optional in-process renderer for CSV files; LibreOffice is used without it
+try:
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, PageBreak
+except ImportError:
+    SimpleDocTemplate = None
+
+from config.settings import UNOSERVER_PORT, UNOSERVER_UNO_PORT
+from utils.file_utils import ConvertedDocument, is_nonempty_file
+from utils.process_utils import run_command
+from utils.libreoffice_utils import libreoffice_profile
 
 logger = logging.getLogger(__name__)
 
+# unoconv fallback, resolved once against PATH at import
+_UNOCONV = shutil.which("unoconv")
+
+# Calc print settings for narrow margins, landscape and fit-to-width output
+CALC_PRINT_REGISTRY = """<?xml version="1.0" encoding="UTF-8"?>
+<oor:items xmlns:oor="http://openoffice.org/2001/registry" xmlns:xs="http://www.w3.org/2001/XMLSchema">
+<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Left" oor:op="fuse"><value>0</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Right" oor:op="fuse"><value>0</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Top" oor:op="fuse"><value>0</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Bottom" oor:op="fuse"><value>0</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="PageFormat" oor:op="fuse"><value>user</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="Orientation" oor:op="fuse"><value>landscape</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="Width" oor:op="fuse"><value>29700</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="Height" oor:op="fuse"><value>21000</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Scale"><prop oor:name="ScaleToPages" oor:op="fuse"><value>1</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Scale"><prop oor:name="ScaleToWidth" oor:op="fuse"><value>1</value></prop></item>
+<item oor:path="/org.openoffice.Office.Calc/Print/Scale"><prop oor:name="ScaleToHeight" oor:op="fuse"><value>0</value></prop></item>
+</oor:items>"""
+
+class _SofficeDaemon:
+    """
+    Keeps one headless LibreOffice instance alive behind unoserver so each
+    conversion skips LibreOffice's startup. Only used when unoserver is installed.
+    """
+    
+    HOST = "127.0.0.1"
+    PORT = UNOSERVER_PORT
+    UNO_PORT = UNOSERVER_UNO_PORT
+    STARTUP_TIMEOUT = 30  # seconds
+    STOP_TIMEOUT = 10  # seconds
+    
+    _process = None
+    _unavailable = False
+    _lock = threading.Lock()
+    
+    @classmethod
+    def _is_listening(cls):
+        try:
+            with socket.create_connection((cls.HOST, cls.PORT), timeout=1):
+                return True
+        except OSError:
+            return False
+    
+    @classmethod
+    def ensure_started(cls):
+        """
+        Start the daemon if it is not already running.
+        
+        Returns:
+            bool: True if the daemon is accepting connections
+        """
+        with cls._lock:
+            if cls._process is not None and cls._process.poll() is None:
+                return True
+            if cls._unavailable:
+                return False
+            
+            if not shutil.which("unoserver") or not shutil.which("unoconvert"):
+                cls._unavailable = True
+                return False
+            
+            # Never hand documents to a server this process did not start
+            if cls._is_listening():
+                logger.warning(f"Port {cls.PORT} is already in use, using one-shot conversions")
+                cls._unavailable = True
+                return False
+            
+            # One profile per port, so instances on the same host do not share it
+            profile_dir = os.path.join(tempfile.gettempdir(), "file-bot", f"unoserver_profile_{cls.PORT}")
+            registry_dir = os.path.join(profile_dir, "user")
+            os.makedirs(registry_dir, exist_ok=True)
+            with open(os.path.join(registry_dir, "registrymodifications.xcu"), "w") as f:
+                f.write(CALC_PRINT_REGISTRY)
+            
+            logger.info("Starting LibreOffice daemon via unoserver...")
+            cls._process = subprocess.Popen(
+                [
+                    "unoserver",
+                    "--interface", cls.HOST,
+                    "--port", str(cls.PORT),
+                    "--uno-port", str(cls.UNO_PORT),
+                    "--user-installation", f"file://{profile_dir}"
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True  # Own process group, so stop() can reach soffice too
+            )
+            
+            deadline = time.monotonic() + cls.STARTUP_TIMEOUT
+            while time.monotonic() < deadline:
+                if cls._process.poll() is not None:
+                    break
+                if cls._is_listening():
+                    return True
+                time.sleep(0.2)
+            
+            logger.warning("LibreOffice daemon did not come up, using one-shot conversions")
+            if cls._process.poll() is None:
+                cls._process.kill()
+            cls._process = None
+            cls._unavailable = True
+            return False
+    
+    @classmethod
+    def stop(cls):
+        """
+        Stop the daemon if this process started it.
+        """
+        with cls._lock:
+            process = cls._process
+            cls._process = None
+            if process is None or process.poll() is not None:
+                return
+            
+            # unoserver shuts its soffice down on SIGTERM; the group kill is the fallback
+            logger.info("Stopping LibreOffice daemon...")
+            process.terminate()
+            try:
+                process.wait(timeout=cls.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                process.wait()
+    
+    @classmethod
+    def convert(cls, input_path, output_path, filter_name, filter_options):
+        """
+        Convert a document through the running daemon.
+        
+        Args:
+            input_path (str): Path to the input document
+            output_path (str): Path of the PDF to write
+            filter_name (str): LibreOffice export filter name
+            filter_options (list): "Name=Value" export filter options
+            
+        Returns:
+            bool: True if the output PDF was written
+        """
+        if not cls.ensure_started():
+            return False
+        
+        cmd = [
+            "unoconvert",
+            "--host", cls.HOST,
+            "--port", str(cls.PORT),
+            "--convert-to", "pdf",
+            "--filter", filter_name
+        ]
+        for option in filter_options:
+            cmd.extend(["--filter-options", option])
+        cmd.extend([input_path, output_path])
+        
+        try:
+            returncode, stderr_tail = run_command(cmd, timeout=180)
+            if returncode != 0:
+                logger.warning(f"unoconvert failed: {stderr_tail}")
+        except subprocess.TimeoutExpired:
+            logger.error(f"unoconvert timed out for: {input_path}")
+            return False
+        
+        return is_nonempty_file(output_path)
+
 class ExcelToPdfWorkflow:
     """Handles the Excel to PDF conversion workflow."""
     
+    # Leading bytes each spreadsheet container starts with
+    ZIP_SIGNATURE = b"PK\x03\x04"
+    OLE2_SIGNATURE = b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
+    EXPECTED_SIGNATURES = {
+        '.xlsx': ZIP_SIGNATURE,
+        '.xlsm': ZIP_SIGNATURE,
+        '.xlsb': ZIP_SIGNATURE,
+        '.xls': OLE2_SIGNATURE
+    }
+    
+    # Text encodings a CSV may announce with a byte order mark; UTF-16 text
+    # is full of NUL bytes, so these are recognised before the binary check
+    CSV_BOM_ENCODINGS = (
+        (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')
+    )
+    
+    # Longest CSV rendered in-process; larger files go to LibreOffice
+    FAST_PATH_MAX_ROWS = 5000
+    
+    @staticmethod
+    def matches_file_signature(file_path, extension):
+        """
+        Check that a spreadsheet's content matches its extension by its leading
+        bytes, so mislabelled files are rejected before LibreOffice starts.
+        
+        Args:
+            file_path (str): Path to the spreadsheet
+            extension (str): Lower-case file extension including the dot
+            
+        Returns:
+            bool: True if the content looks like the extension's format
+        """
+        with open(file_path, 'rb') as f:
+            head = f.read(4096)
+        
+        expected = ExcelToPdfWorkflow.EXPECTED_SIGNATURES.get(extension)
+        if expected is not None:
+            return head.startswith(expected)
+        
+        # CSV must be text: a byte order mark, or no container signature and no NUL bytes
+        if any(head.startswith(bom) for bom, _ in ExcelToPdfWorkflow.CSV_BOM_ENCODINGS):
+            return True
+        return not head.startswith((ExcelToPdfWorkflow.ZIP_SIGNATURE, ExcelToPdfWorkflow.OLE2_SIGNATURE)) and b"\x00" not in head
+    
+    @staticmethod
+    def stop_libreoffice_daemon():
+        """
+        Stop the LibreOffice daemon started for spreadsheet conversions, if any.
+        """
+        _SofficeDaemon.stop()
+    
+    @staticmethod
+    def _render_tables_to_pdf(sheets, output_path):
+        """
+        Draw rows of text as one table per sheet on landscape A4 pages.
+        
+        Args:
+            sheets (iterable): One iterable of row value sequences per sheet
+            output_path (str): Path of the PDF to write
+            
+        Returns:
+            str: Path to the generated PDF or None if a sheet does not fit
+        """
+        doc = SimpleDocTemplate(
+            output_path,
+            pagesize=landscape(A4),
+            leftMargin=18,
+            rightMargin=18,
+            topMargin=18,
+            bottomMargin=18
+        )
+        table_style = TableStyle([
+            ("FONTSIZE", (0, 0), (-1, -1), 7),
+            ("GRID", (0, 0), (-1, -1), 0.25, colors.grey),
+            ("VALIGN", (0, 0), (-1, -1), "TOP")
+        ])
+        
+        story = []
+        for sheet_rows in sheets:
+            rows = []
+            for row in sheet_rows:
+                if len(rows) >= ExcelToPdfWorkflow.FAST_PATH_MAX_ROWS:
+                    return None
+                rows.append(["" if value is None else str(value) for value in row])
+            
+            # Trim trailing empty rows and columns
+            while rows and not any(rows[-1]):
+                rows.pop()
+            if not rows:
+                continue
+            width = max(
+                max((i + 1 for i, value in enumerate(row) if value), default=0)
+                for row in rows
+            )
+            rows = [row[:width] + [""] * (width - len(row)) for row in rows]
+            
+            table = Table(rows, repeatRows=1)
+            table.setStyle(table_style)
+            table_width, _ = table.wrap(doc.width, doc.height)
+            if table_width > doc.width:
+                return None
+            
+            if story:
+                story.append(PageBreak())
+            story.append(table)
+        
+        if not story:
+            return None
+        
+        doc.build(story)
+        return output_path if os.path.exists(output_path) else None
+    
+    @staticmethod
+    def convert_csv_to_pdf(input_path, output_path):
+        """
+        Render a CSV file straight to PDF with the csv module and reportlab.
+        
+        Args:
+            input_path (str): Path to the .csv file
+            output_path (str): Path of the PDF to write
+            
+        Returns:
+            str: Path to the generated PDF or None if the fast path does not apply
+        """
+        if SimpleDocTemplate is None or not input_path.lower().endswith('.csv'):
+            return None
+        
+        try:
+            with open(input_path, 'rb') as f:
+                head = f.read(4)
+            encoding = next(
+                (name for bom, name in ExcelToPdfWorkflow.CSV_BOM_ENCODINGS if head.startswith(bom)),
+                'utf-8-sig'
+            )
+            
+            with open(input_path, newline='', encoding=encoding, errors='replace') as f:
+                try:
+                    dialect = csv.Sniffer().sniff(f.read(4096))
+                except csv.Error:
+                    dialect = csv.excel
+                f.seek(0)
+                return ExcelToPdfWorkflow._render_tables_to_pdf([csv.reader(f, dialect)], output_path)
+            
+        except Exception as e:
+            logger.warning(f"In-process CSV rendering failed, using LibreOffice: {str(e)}")
+            return None
+    
     @staticmethod
     def convert_excel_to_pdf_with_libreoffice(input_path, output_dir):
         """
@@ -33,7 +364,7 @@ class ExcelToPdfWorkflow:
             abs_output_dir = os.path.abspath(output_dir)
             
             # Ensure input file exists and has size > 0
-            if not os.path.exists(abs_input_path) or os.path.getsize(abs_input_path) == 0:
+            if not is_nonempty_file(abs_input_path):
                 logger.error(f"Input file does not exist or is empty: {abs_input_path}")
                 return None
                 
@@ -45,67 +376,48 @@ class ExcelToPdfWorkflow:
             output_filename = os.path.splitext(input_filename)[0] + '.pdf'
             output_path = os.path.join(abs_output_dir, output_filename)
             
-            # Create a temporary macro to apply narrow margins and fit width
-            macro_dir = os.path.join(abs_output_dir, "macro")
-            os.makedirs(macro_dir, exist_ok=True)
-            
-            # Create a temporary excel file with adjusted settings
-            temp_output_excel = os.path.join(abs_output_dir, f"temp_{input_filename}")
-            
-            # Create user profile directory to store custom settings
-            user_profile_dir = os.path.join(abs_output_dir, "libreoffice_user_profile")
-            os.makedirs(user_profile_dir, exist_ok=True)
-            
-            # First, copy the spreadsheet and set narrow margins using the soffice command
-            logger.info(f"Creating a temporary Excel file with narrow margins: {temp_output_excel}")
+            # CSV files carry no layout, so they are rendered in-process without LibreOffice;
+            # workbooks keep their column widths, merges and styling through LibreOffice
+            if ExcelToPdfWorkflow.convert_csv_to_pdf(abs_input_path, output_path):
+                logger.info(f"Successfully converted to PDF in-process: {output_path}")
+                return output_path
             
-            # Create settings file with narrow margins in user profile directory
-            registrymodifications_file = os.path.join(user_profile_dir, "registrymodifications.xcu")
-            with open(registrymodifications_file, "w") as f:
-                f.write("""<?xml version="1.0" encoding="UTF-8"?>
-<oor:items xmlns:oor="http://openoffice.org/2001/registry" xmlns:xs="http://www.w3.org/2001/XMLSchema">
-<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Left" oor:op="fuse"><value>0</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Right" oor:op="fuse"><value>0</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Top" oor:op="fuse"><value>0</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page/Margin"><prop oor:name="Bottom" oor:op="fuse"><value>0</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="PageFormat" oor:op="fuse"><value>user</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="Orientation" oor:op="fuse"><value>landscape</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="Width" oor:op="fuse"><value>29700</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Page"><prop oor:name="Height" oor:op="fuse"><value>21000</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Scale"><prop oor:name="ScaleToPages" oor:op="fuse"><value>1</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Scale"><prop oor:name="ScaleToWidth" oor:op="fuse"><value>1</value></prop></item>
-<item oor:path="/org.openoffice.Office.Calc/Print/Scale"><prop oor:name="ScaleToHeight" oor:op="fuse"><value>0</value></prop></item>
-</oor:items>""")
+            # Method 0: Hand the file to the long-running LibreOffice daemon when available
+            if _SofficeDaemon.convert(
+                abs_input_path,
+                output_path,
+                "calc_pdf_Export",
+                ["ScaleToWidth=1", "LeftMargin=0", "RightMargin=0", "TopMargin=0", "BottomMargin=0", "PageOrientation=1"]
+            ):
+                logger.info(f"Successfully converted to PDF via LibreOffice daemon: {output_path}")
+                return output_path
             
             # Method 1: Direct PDF export with minimal margins, landscape mode, and scaling
             logger.info("Converting Excel to PDF using direct export with minimal margins...")
-            cmd = [
-                'libreoffice',
-                '--headless',
-                f'-env:UserInstallation=file://{user_profile_dir}',
-                '--convert-to', 'pdf:calc_pdf_Export:{"ScaleToWidth":1,"LeftMargin":0,"RightMargin":0,"TopMargin":0,"BottomMargin":0,"PageOrientation":1}',
-                '--outdir', abs_output_dir,
-                abs_input_path
-            ]
-            
-            process = subprocess.run(
-                cmd,
-                check=False,
-                capture_output=True,
-                text=True,
-                timeout=180  # 3 minutes timeout for large spreadsheets
-            )
-            
-            logger.info(f"LibreOffice process returned code: {process.returncode}")
             
-            if process.stdout:
-                logger.info(f"LibreOffice output: {process.stdout}")
-            
-            if process.stderr:
-                logger.warning(f"LibreOffice warnings: {process.stderr}")
+            # Leased profile with the narrow-margin settings; profiles are kept
+            # between runs so LibreOffice does not initialise one for every file
+            with libreoffice_profile(CALC_PRINT_REGISTRY) as user_installation:
+                cmd = [
+                    'libreoffice',
+                    '--headless',
+                    user_installation,
+                    '--convert-to', 'pdf:calc_pdf_Export:{"ScaleToWidth":1,"LeftMargin":0,"RightMargin":0,"TopMargin":0,"BottomMargin":0,"PageOrientation":1}',
+                    '--outdir', abs_output_dir,
+                    abs_input_path
+                ]
+                returncode, stderr_tail = run_command(
+                    cmd,
+                    timeout=180  # 3 minutes timeout for large spreadsheets
+                )
+            
+            logger.info(f"LibreOffice process returned code: {returncode}")
+            
+            if stderr_tail:
+                logger.warning(f"LibreOffice warnings: {stderr_tail}")
             
             # Check if the output file exists
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            if is_nonempty_file(output_path):
                 logger.info(f"Successfully converted to PDF: {output_path}")
                 return output_path
             
@@ -113,12 +425,9 @@ class ExcelToPdfWorkflow:
             logger.info("First method failed. Trying with unoconv if available...")
             try:
                 # Check if unoconv is installed
-                check_cmd = ["which", "unoconv"]
-                check_process = subprocess.run(check_cmd, capture_output=True, text=True)
-                
-                if check_process.returncode == 0:
+                if _UNOCONV:
                     unoconv_cmd = [
-                        "unoconv",
+                        _UNOCONV,
                         "-f", "pdf",
                         "-o", abs_output_dir,
                         "-P", "PaperOrientation=landscape",
@@ -130,18 +439,12 @@ class ExcelToPdfWorkflow:
                         abs_input_path
                     ]
                     
-                    unoconv_process = subprocess.run(
-                        unoconv_cmd,
-                        check=False,
-                        capture_output=True,
-                        text=True,
-                        timeout=180
-                    )
+                    unoconv_returncode, _ = run_command(unoconv_cmd, timeout=180)
                     
-                    logger.info(f"unoconv process returned code: {unoconv_process.returncode}")
+                    logger.info(f"unoconv process returned code: {unoconv_returncode}")
                     
                     # Check if the output file exists
-                    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+                    if is_nonempty_file(output_path):
                         logger.info(f"Successfully converted to PDF using unoconv: {output_path}")
                         return output_path
             except Exception as e:
@@ -149,24 +452,19 @@ class ExcelToPdfWorkflow:
             
             # Method 3: Last resort - try using soffice with basic settings
             logger.info("Trying basic soffice command with standard settings...")
-            cmd = [
-                'soffice',
-                '--headless',
-                '--convert-to', 'pdf',
-                '--outdir', abs_output_dir,
-                abs_input_path
-            ]
-            
-            process = subprocess.run(
-                cmd,
-                check=False,
-                capture_output=True,
-                text=True,
-                timeout=180
-            )
+            with libreoffice_profile() as user_installation:
+                cmd = [
+                    'soffice',
+                    '--headless',
+                    user_installation,
+                    '--convert-to', 'pdf',
+                    '--outdir', abs_output_dir,
+                    abs_input_path
+                ]
+                run_command(cmd, timeout=180)
             
             # Check one last time
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            if is_nonempty_file(output_path):
                 logger.info(f"Successfully converted to PDF with basic soffice command: {output_path}")
                 return output_path
             
@@ -179,19 +477,6 @@ class ExcelToPdfWorkflow:
         except Exception as e:
             logger.error(f"Error in Excel conversion: {str(e)}")
             return None
-        finally:
-            # Clean up any temporary files
-            try:
-                if 'user_profile_dir' in locals() and os.path.exists(user_profile_dir):
-                    import shutil
-                    shutil.rmtree(user_profile_dir, ignore_errors=True)
-                if 'macro_dir' in locals() and os.path.exists(macro_dir):
-                    import shutil
-                    shutil.rmtree(macro_dir, ignore_errors=True)
-                if 'temp_output_excel' in locals() and os.path.exists(temp_output_excel):
-                    os.remove(temp_output_excel)
-            except Exception as e:
-                logger.warning(f"Error cleaning up temporary files: {str(e)}")
     
     @staticmethod
     def handle_spreadsheet_save(task_dir, message_id, saved_filename, workflow_info):
@@ -215,9 +500,8 @@ class ExcelToPdfWorkflow:
             filename_base, filename_ext = os.path.splitext(saved_filename)
             
             # Try to get the original filename from the workflow_info
-            original_filename = None
-            if 'original_filenames' in workflow_info and message_id in workflow_info['original_filenames']:
-                original_filename = workflow_info['original_filenames'][message_id]
+            document = workflow_info.setdefault('documents', {}).setdefault(message_id, ConvertedDocument())
+            original_filename = document.original_name
             
             # If no original filename, use message_id as base
             if not original_filename:
@@ -231,6 +515,10 @@ class ExcelToPdfWorkflow:
                 logger.warning(f"Not an Excel spreadsheet: {saved_filename}")
                 return saved_filename, f"File {saved_filename} is not an Excel file. Please send a .xls, .xlsx, .xlsm, .xlsb, or .csv file."
             
+            if not ExcelToPdfWorkflow.matches_file_signature(file_path, filename_ext.lower()):
+                logger.warning(f"Spreadsheet content does not match its extension: {saved_filename}")
+                return saved_filename, f"File {saved_filename} does not look like a valid {filename_ext.lower()} spreadsheet. Please check the file and try again."
+            
             # Create PDF output filename using original name
             pdf_filename = f"{original_base}.pdf"
             pdf_path = os.path.join(task_dir, pdf_filename)
@@ -249,14 +537,8 @@ class ExcelToPdfWorkflow:
                 logger.info(f"Successfully converted to PDF: {pdf_filename}")
                 
                 # Store the file references in workflow info
-                if 'spreadsheet_versions' not in workflow_info:
-                    workflow_info['spreadsheet_versions'] = {}
-                
-                workflow_info['spreadsheet_versions'][message_id] = {
-                    'original': saved_filename,
-                    'pdf': os.path.basename(output_pdf_path),
-                    'original_name': original_filename
-                }
+                document.original = saved_filename
+                document.pdf = os.path.basename(output_pdf_path)
                 
                 return saved_filename, f"Excel spreadsheet converted to PDF successfully. The PDF will be available when you type 'done'."
             else:
@@ -283,31 +565,32 @@ class ExcelToPdfWorkflow:
         
         try:
             # Check if we have any spreadsheets
-            if 'spreadsheet_versions' not in workflow_info or not workflow_info['spreadsheet_versions']:
+            documents = [
+                document for document in workflow_info.get('documents', {}).values()
+                if document.pdf
+            ]
+            if not documents:
                 logger.warning("No Excel spreadsheets received for conversion.")
                 return []
             
             # Collect all PDF files
-            for message_id, versions in workflow_info['spreadsheet_versions'].items():
-                if 'pdf' in versions:
-                    pdf_path = os.path.join(task_dir, versions['pdf'])
-                    if os.path.exists(pdf_path):
-                        output_files.append(pdf_path)
-                        logger.info(f"Added PDF to result list: {versions['pdf']}")
-                    else:
-                        logger.warning(f"PDF file not found: {versions['pdf']}")
+            for document in documents:
+                pdf_path = os.path.join(task_dir, document.pdf)
+                if os.path.exists(pdf_path):
+                    output_files.append(pdf_path)
+                    logger.info(f"Added PDF to result list: {document.pdf}")
+                else:
+                    logger.warning(f"PDF file not found: {document.pdf}")
             
             # Create a merged PDF if multiple spreadsheets were converted
             if len(output_files) > 1:
-                from pypdf import PdfReader, PdfWriter
-                
                 merged_pdf_path = os.path.join(task_dir, "Merged_Spreadsheets.pdf")
                 writer = PdfWriter()
                 
+                # Append each document whole so pypdf copies its object tree in
+                # one pass instead of cloning pages one at a time
                 for pdf_path in output_files:
-                    reader = PdfReader(pdf_path)
-                    for page in reader.pages:
-                        writer.add_page(page)
+                    writer.append(pdf_path)
                 
                 with open(merged_pdf_path, "wb") as output_file:
                     writer.write(output_file)
@@ -1,21 +1,162 @@
 """
 Workflow for converting markdown text messages to PDF.
-First tries md-to-pdf (ARM compatible), then falls back to md2pdf or pandoc.
+First renders in a persistent Chromium browser, then falls back to the
+md-to-pdf CLI (ARM compatible), md2pdf or pandoc.
 """
 
 import os
 import logging
 import subprocess
 import json
+import shutil
 import tempfile
+import hashlib
+import threading
 from datetime import datetime
 
+try:
+    from playwright.sync_api import sync_playwright
+except ImportError:
+    sync_playwright = None
+
+try:
+    from markdown_it import MarkdownIt
+except ImportError:
+    MarkdownIt = None
+
+try:
+    from weasyprint import HTML
+except (ImportError, OSError):  # OSError when its native libraries are missing
+    HTML = None
+
+from utils.file_cache import FileCache
+
 # Initialize logger
 logger = logging.getLogger(__name__)
 
+# Largest document (in bytes) rendered with WeasyPrint when no browser is
+# available; larger ones go to the command-line converters
+WEASYPRINT_MAX_BYTES = 50_000
+
+# Chromium used for rendering, matching the md-to-pdf launch options
+CHROMIUM_EXECUTABLE = "/usr/bin/chromium-browser"
+CHROMIUM_ARGS = ["--no-sandbox", "--disable-setuid-sandbox"]
+
+# Command-line converters, resolved once so missing tools are skipped without a spawn
+_MDTOPDF = shutil.which("md-to-pdf")
+_MD2PDF = shutil.which("md2pdf")
+_PANDOC = shutil.which("pandoc")
+
+# md-to-pdf --launch-options value, serialized once
+MDTOPDF_LAUNCH_OPTIONS = json.dumps({
+    "executablePath": CHROMIUM_EXECUTABLE,
+    "args": CHROMIUM_ARGS
+})
+
+# Page wrapper for the rendered markdown
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<style>
+body { font-family: -apple-system, "Segoe UI", Helvetica, Arial, sans-serif; font-size: 12pt; line-height: 1.5; }
+pre, code { font-family: Menlo, Consolas, monospace; font-size: 10pt; background: #f6f8fa; }
+pre { padding: 8px; white-space: pre-wrap; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #d0d7de; padding: 4px 8px; }
+blockquote { margin-left: 0; padding-left: 12px; border-left: 4px solid #d0d7de; color: #57606a; }
+</style>
+</head>
+<body>
+%s
+</body>
+</html>
+"""
+
+_markdown_renderer = MarkdownIt("commonmark").enable("table") if MarkdownIt is not None else None
+
+# Playwright's sync API is bound to the thread that started it, so each
+# worker thread keeps its own long-lived browser
+_browser_local = threading.local()
+
+# Threads currently owning a Playwright instance, so shutdown knows whether
+# any browsers are left to close
+_browser_threads = set()
+_browser_threads_lock = threading.Lock()
+
+def _get_browser():
+    """
+    Returns this thread's Chromium browser, launching it on first use.
+    
+    Returns:
+        Browser: A connected Playwright browser
+    """
+    browser = getattr(_browser_local, "browser", None)
+    if browser is not None and browser.is_connected():
+        return browser
+    
+    playwright = getattr(_browser_local, "playwright", None)
+    if playwright is None:
+        playwright = sync_playwright().start()
+        _browser_local.playwright = playwright
+        with _browser_threads_lock:
+            _browser_threads.add(threading.get_ident())
+    
+    launch_kwargs = {"args": CHROMIUM_ARGS}
+    if os.path.exists(CHROMIUM_EXECUTABLE):
+        launch_kwargs["executable_path"] = CHROMIUM_EXECUTABLE
+    browser = playwright.chromium.launch(**launch_kwargs)
+    _browser_local.browser = browser
+    logger.info(f"Launched Chromium for markdown rendering in {threading.current_thread().name}")
+    return browser
+
+def _close_browser():
+    """
+    Closes this thread's browser and stops its Playwright instance, if the
+    thread started them. Must run on the owning thread.
+    """
+    browser = getattr(_browser_local, "browser", None)
+    playwright = getattr(_browser_local, "playwright", None)
+    _browser_local.browser = None
+    _browser_local.playwright = None
+    
+    if browser is not None:
+        try:
+            browser.close()
+        except Exception as e:
+            logger.warning(f"Error closing Chromium: {str(e)}")
+    if playwright is not None:
+        try:
+            playwright.stop()
+        except Exception as e:
+            logger.warning(f"Error stopping Playwright: {str(e)}")
+        with _browser_threads_lock:
+            _browser_threads.discard(threading.get_ident())
+
+def _markdown_fragments(markdown_content, title=None):
+    """
+    Yields the encoded markdown document, separating messages by blank lines.
+    
+    Args:
+        markdown_content (list): Markdown messages, as text or UTF-8 bytes
+        title (str): Document title
+    """
+    if title:
+        yield f"# {title}\n\n".encode("utf-8")
+    for index, chunk in enumerate(markdown_content):
+        if index:
+            yield b"\n\n"
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
 class MarkdownToPdfWorkflow:
     """Handles markdown text to PDF conversion with fallback mechanisms."""
     
+    # Rendered PDFs keyed by document content, so repeated conversions skip rendering
+    RESULT_CACHE = FileCache(
+        os.path.join(tempfile.gettempdir(), "file-bot", "markdown_cache"),
+        256 << 20  # 256 MiB
+    )
+    
     @staticmethod
     def append_markdown_content(task_dir, message_id, text_content, workflow_info=None):
         """
@@ -35,17 +176,99 @@ class MarkdownToPdfWorkflow:
             
         # Initialize markdown content if not already present
         if "markdown_content" not in workflow_info:
-            workflow_info["markdown_content"] = []
+            workflow_info["markdown_content"] = bytearray()
             workflow_info["message_ids"] = []
             
-        # Add new content
-        workflow_info["markdown_content"].append(text_content)
+        # Add new content, encoded once and separated from the previous message by a blank line
+        markdown_buffer = workflow_info["markdown_content"]
+        if markdown_buffer:
+            markdown_buffer.extend(b"\n\n")
+        markdown_buffer.extend(text_content.encode("utf-8"))
         workflow_info["message_ids"].append(message_id)
         
         # Create a message to acknowledge receipt
-        msg_count = len(workflow_info["markdown_content"])
+        msg_count = len(workflow_info["message_ids"])
         return True, f"Markdown content received ({msg_count} message{'s' if msg_count > 1 else ''}). Send more markdown text or 'done' to generate PDF."
     
+    @staticmethod
+    def convert_markdown_to_pdf_with_browser(markdown_text, pdf_path):
+        """
+        Convert markdown to PDF in-process, rendering the HTML with a reused
+        Chromium browser instead of starting one per document.
+        
+        Args:
+            markdown_text (str): Markdown document text
+            pdf_path (str): Output PDF path
+            
+        Returns:
+            dict: Result information
+        """
+        if sync_playwright is None or _markdown_renderer is None:
+            return {
+                "success": False,
+                "error": "playwright or markdown-it-py is not installed"
+            }
+        
+        try:
+            html = HTML_TEMPLATE % _markdown_renderer.render(markdown_text)
+            
+            page = _get_browser().new_page()
+            try:
+                page.set_content(html)
+                page.pdf(
+                    path=pdf_path,
+                    format="A4",
+                    margin={"top": "20mm", "bottom": "20mm", "left": "20mm", "right": "20mm"},
+                    print_background=True
+                )
+            finally:
+                page.close()
+            
+            return {
+                "success": True,
+                "path": pdf_path,
+                "method": "playwright"
+            }
+        except Exception as e:
+            logger.error(f"Error in browser markdown conversion: {str(e)}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
+    @staticmethod
+    def convert_markdown_to_pdf_with_weasyprint(markdown_text, pdf_path):
+        """
+        Convert markdown to PDF in-process with WeasyPrint, for short documents
+        when no browser is available.
+        
+        Args:
+            markdown_text (str): Markdown document text
+            pdf_path (str): Output PDF path
+            
+        Returns:
+            dict: Result information
+        """
+        if HTML is None or _markdown_renderer is None:
+            return {
+                "success": False,
+                "error": "weasyprint or markdown-it-py is not installed"
+            }
+        
+        try:
+            HTML(string=HTML_TEMPLATE % _markdown_renderer.render(markdown_text)).write_pdf(pdf_path)
+            return {
+                "success": True,
+                "path": pdf_path,
+                "method": "weasyprint"
+            }
+        except Exception as e:
+            logger.error(f"Error in WeasyPrint markdown conversion: {str(e)}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+    
     @staticmethod
     def convert_markdown_to_pdf_with_mdtopdf(task_dir, md_path, pdf_path):
         """
@@ -59,26 +282,24 @@ class MarkdownToPdfWorkflow:
         Returns:
             dict: Result information
         """
-        try:
-            # Launch options for ARM compatibility
-            launch_options = {
-                "executablePath": "/usr/bin/chromium-browser",
-                "args": ["--no-sandbox", "--disable-setuid-sandbox"]
+        if not _MDTOPDF:
+            return {
+                "success": False,
+                "error": "md-to-pdf is not installed"
             }
+        
+        try:
+            # Construct the md-to-pdf command with the ARM-compatible launch options
+            command = [_MDTOPDF, f"--launch-options={MDTOPDF_LAUNCH_OPTIONS}", md_path]
             
-            # Construct the md-to-pdf command
-            launch_options_str = json.dumps(launch_options)
-            command = f"md-to-pdf --launch-options='{launch_options_str}' {md_path}"
-            
-            logger.info(f"Running command: {command}")
+            logger.info(f"Running command: {' '.join(command)}")
             
-            # Execute the command with shell=True to preserve quotes
+            # Execute directly; without a shell the JSON needs no quoting
             process = subprocess.run(
                 command,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 text=True,
-                shell=True,
                 cwd=task_dir
             )
             
@@ -92,9 +313,9 @@ class MarkdownToPdfWorkflow:
             # Check if PDF was created - md-to-pdf outputs to same filename with .pdf extension
             generated_pdf = f"{os.path.splitext(md_path)[0]}.pdf"
             if os.path.exists(generated_pdf):
-                # Rename to expected output path if needed
-                if generated_pdf != pdf_path:
-                    os.rename(generated_pdf, pdf_path)
+                # Move to the expected output path unless it already is that file
+                if not os.path.exists(pdf_path) or not os.path.samefile(generated_pdf, pdf_path):
+                    os.replace(generated_pdf, pdf_path)
                 return {
                     "success": True,
                     "path": pdf_path,
@@ -127,45 +348,51 @@ class MarkdownToPdfWorkflow:
         """
         try:
             # Try md2pdf command-line tool first
-            try:
-                result = subprocess.run(
-                    ["md2pdf", md_path, pdf_path],
-                    capture_output=True,
-                    text=True,
-                    check=True
-                )
-                
-                if os.path.exists(pdf_path):
-                    return {
-                        "success": True,
-                        "path": pdf_path,
-                        "method": "md2pdf"
-                    }
-                else:
-                    raise Exception("PDF file was not created by md2pdf")
+            if _MD2PDF:
+                try:
+                    result = subprocess.run(
+                        [_MD2PDF, md_path, pdf_path],
+                        capture_output=True,
+                        text=True,
+                        check=True
+                    )
                     
-            except subprocess.CalledProcessError as e:
-                logger.error(f"md2pdf command failed: {e.stderr}")
-                # Try using pandoc as a fallback
-                logger.warning("md2pdf command failed, trying pandoc as fallback...")
-                
-                pandoc_result = subprocess.run(
-                    ["pandoc", md_path, "-o", pdf_path],
-                    capture_output=True,
-                    text=True
-                )
-                
-                if pandoc_result.returncode != 0:
-                    raise Exception(f"Pandoc conversion failed: {pandoc_result.stderr}")
-                
-                if os.path.exists(pdf_path):
-                    return {
-                        "success": True,
-                        "path": pdf_path,
-                        "method": "pandoc"
-                    }
-                else:
-                    raise Exception("PDF file was not created by pandoc")
+                    if os.path.exists(pdf_path):
+                        return {
+                            "success": True,
+                            "path": pdf_path,
+                            "method": "md2pdf"
+                        }
+                    else:
+                        raise Exception("PDF file was not created by md2pdf")
+                        
+                except subprocess.CalledProcessError as e:
+                    logger.error(f"md2pdf command failed: {e.stderr}")
+                    logger.warning("md2pdf command failed, trying pandoc as fallback...")
+            else:
+                logger.warning("md2pdf is not installed, trying pandoc as fallback...")
+            
+            # Try using pandoc as a fallback
+            if not _PANDOC:
+                raise Exception("pandoc is not installed")
+            
+            pandoc_result = subprocess.run(
+                [_PANDOC, md_path, "-o", pdf_path],
+                capture_output=True,
+                text=True
+            )
+            
+            if pandoc_result.returncode != 0:
+                raise Exception(f"Pandoc conversion failed: {pandoc_result.stderr}")
+            
+            if os.path.exists(pdf_path):
+                return {
+                    "success": True,
+                    "path": pdf_path,
+                    "method": "pandoc"
+                }
+            else:
+                raise Exception("PDF file was not created by pandoc")
                 
         except Exception as e:
             logger.error(f"Failed to convert markdown to PDF with md2pdf/pandoc: {str(e)}")
@@ -175,30 +402,102 @@ class MarkdownToPdfWorkflow:
             }
     
     @staticmethod
-    def convert_markdown_to_pdf(task_dir, markdown_content, output_filename="output.pdf", title=None):
+    def result_cache_key(markdown_content, title=None):
+        """
+        Build the RESULT_CACHE key for a markdown document.
+        
+        Args:
+            markdown_content (list): Markdown messages, as text or UTF-8 bytes
+            title (str): Document title
+            
+        Returns:
+            str: BLAKE2b digest of the document text
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for fragment in _markdown_fragments(markdown_content, title):
+            digest.update(fragment)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def convert_markdown_to_pdf(task_dir, markdown_content, output_filename="output.pdf", title=None, keep_source=False):
         """
         Convert markdown content to PDF using multiple methods with fallback.
-        First tries md-to-pdf (ARM compatible), then falls back to md2pdf/pandoc.
+        First renders in the persistent browser, then with WeasyPrint for short
+        documents, then tries the md-to-pdf CLI (ARM compatible), then falls
+        back to md2pdf/pandoc.
         
         Args:
             task_dir (str): Task directory path
-            markdown_content (str): Combined markdown content
+            markdown_content (str, bytes or list): Markdown content as text or
+                UTF-8 bytes, or a list of messages to be separated by blank lines
             output_filename (str): Output PDF filename
             title (str): Document title
+            keep_source (bool): Whether to write the markdown file even when
+                the in-process renderer does not need it
             
         Returns:
             dict: Result information
         """
         try:
-            # Create a markdown file with all the content
             md_file_path = os.path.join(task_dir, "combined_content.md")
-            with open(md_file_path, "w", encoding="utf-8") as md_file:
-                if title:
-                    md_file.write(f"# {title}\n\n")
-                md_file.write(markdown_content)
+            if isinstance(markdown_content, (str, bytes, bytearray)):
+                markdown_content = [markdown_content]
+            
+            # The command-line converters read the content from a markdown file
+            def write_source():
+                with open(md_file_path, "wb") as f:
+                    f.write(b"".join(_markdown_fragments(markdown_content, title)))
+            
+            if keep_source:
+                write_source()
             
             output_path = os.path.join(task_dir, output_filename)
             
+            # Reuse the PDF from an earlier conversion of the same document
+            cache_key = MarkdownToPdfWorkflow.result_cache_key(markdown_content, title)
+            if MarkdownToPdfWorkflow.RESULT_CACHE.get(cache_key, output_path):
+                logger.info(f"Reusing cached PDF for markdown document {cache_key}")
+                result = {
+                    "success": True,
+                    "path": output_path,
+                    "method": "cache"
+                }
+                if keep_source:
+                    result["source_md"] = md_file_path
+                return result
+            
+            # Try the persistent browser first, rendering straight from memory
+            if sync_playwright is not None and _markdown_renderer is not None:
+                result = MarkdownToPdfWorkflow.convert_markdown_to_pdf_with_browser(
+                    b"".join(_markdown_fragments(markdown_content, title)).decode("utf-8"),
+                    output_path
+                )
+                
+                if result["success"]:
+                    MarkdownToPdfWorkflow.RESULT_CACHE.put(cache_key, output_path)
+                    if keep_source:
+                        result["source_md"] = md_file_path
+                    return result
+                logger.info("Browser rendering failed, falling back to the md-to-pdf CLI...")
+            
+            # Short documents render in-process faster than any converter starts up
+            if HTML is not None and _markdown_renderer is not None:
+                markdown_bytes = b"".join(_markdown_fragments(markdown_content, title))
+                if len(markdown_bytes) < WEASYPRINT_MAX_BYTES:
+                    result = MarkdownToPdfWorkflow.convert_markdown_to_pdf_with_weasyprint(
+                        markdown_bytes.decode("utf-8"),
+                        output_path
+                    )
+                    
+                    if result["success"]:
+                        MarkdownToPdfWorkflow.RESULT_CACHE.put(cache_key, output_path)
+                        if keep_source:
+                            result["source_md"] = md_file_path
+                        return result
+            
+            if not keep_source:
+                write_source()
+            
             # Try method 1: md-to-pdf (ARM compatible)
             logger.info("Trying md-to-pdf method...")
             result = MarkdownToPdfWorkflow.convert_markdown_to_pdf_with_mdtopdf(
@@ -209,6 +508,7 @@ class MarkdownToPdfWorkflow:
             
             if result["success"]:
                 logger.info("md-to-pdf method succeeded")
+                MarkdownToPdfWorkflow.RESULT_CACHE.put(cache_key, output_path)
                 result["source_md"] = md_file_path
                 return result
                 
@@ -222,6 +522,7 @@ class MarkdownToPdfWorkflow:
             
             if result["success"]:
                 logger.info(f"{result['method']} method succeeded")
+                MarkdownToPdfWorkflow.RESULT_CACHE.put(cache_key, output_path)
                 result["source_md"] = md_file_path
                 return result
             
@@ -238,6 +539,24 @@ class MarkdownToPdfWorkflow:
                 "error": str(e)
             }
     
+    @staticmethod
+    def has_open_browsers():
+        """
+        Check whether any thread still owns a rendering browser.
+        
+        Returns:
+            bool: True if a browser may still be running
+        """
+        with _browser_threads_lock:
+            return bool(_browser_threads)
+    
+    @staticmethod
+    def close_thread_browser():
+        """
+        Close the rendering browser owned by the calling thread, if any.
+        """
+        _close_browser()
+    
     @staticmethod
     def generate_pdf_from_messages(task_dir, workflow_info):
         """
@@ -256,9 +575,6 @@ class MarkdownToPdfWorkflow:
                 "error": "No markdown content available"
             }
             
-        # Combine all markdown content with proper spacing
-        combined_content = "\n\n".join(workflow_info["markdown_content"])
-        
         # Generate timestamp for the filename
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         output_filename = f"document_{timestamp}.pdf"
@@ -266,7 +582,7 @@ class MarkdownToPdfWorkflow:
         # Convert the combined markdown to PDF (will try methods with fallback)
         return MarkdownToPdfWorkflow.convert_markdown_to_pdf(
             task_dir, 
-            combined_content, 
+            workflow_info["markdown_content"], 
             output_filename,
             title="Markdown Document"
         )
\ No newline at end of file
@@ -3,19 +3,160 @@ PDF Merge workflow handler for the Document Scanner application.
 """
 
 import os
-import logging
 import json
-from pypdf import PdfWriter
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pypdf import PdfReader, PdfWriter
+
+from config.settings import MERGE_FAST_CONCAT
+from utils.file_utils import get_file_hash, reorder
 
-from utils.file_utils import read_order_file, write_order_file
+try:
+    import pikepdf
+except ImportError:
+    pikepdf = None
 
 logger = logging.getLogger(__name__)
 
+# Sidecar recording which inputs produced the current merged PDF
+MERGE_CACHE_FILE = "merge_cache.json"
+
+# Write buffer for the merged PDF; pypdf emits many small writes per object
+MERGE_WRITE_BUFFER = 1 << 20
+
+# Number of input PDFs parsed at once when merging with pypdf
+READER_WORKERS = min(8, os.cpu_count() or 1)
+
+# Smallest plausible PDF, and how far into a file its header may start
+MIN_PDF_BYTES = 64
+PDF_HEADER_WINDOW = 1024
+
+def _prefetch(file_paths):
+    """
+    Asks the kernel to start reading every input into the page cache at once,
+    so parsing finds the data resident instead of blocking on each small read.
+    
+    Args:
+        file_paths (list): Paths to read ahead
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for file_path in file_paths:
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+def _write_preallocated(output_path, size_hint, write):
+    """
+    Writes a file through a large buffer after reserving its expected size in
+    one allocation, then trims it to the bytes actually written.
+    
+    Args:
+        output_path (str): File to create or replace
+        size_hint (int): Expected size in bytes
+        write (callable): Called with the open binary file to produce the content
+    """
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    with os.fdopen(fd, "wb", buffering=MERGE_WRITE_BUFFER) as f_out:
+        if hasattr(os, "posix_fallocate") and size_hint > 0:
+            try:
+                os.posix_fallocate(fd, 0, size_hint)
+            except OSError:
+                pass  # Not supported by the filesystem; write without reserving
+        write(f_out)
+        f_out.truncate(f_out.tell())
+
+def _content_keys(file_sizes):
+    """
+    Maps each file to a key shared only by files with identical content.
+    Files are hashed only when another file has the same size.
+    
+    Args:
+        file_sizes (dict): File path to size in bytes
+        
+    Returns:
+        dict: File path to content key
+    """
+    size_counts = {}
+    for size in file_sizes.values():
+        size_counts[size] = size_counts.get(size, 0) + 1
+    return {
+        file_path: get_file_hash(file_path) if size_counts[size] > 1 else file_path
+        for file_path, size in file_sizes.items()
+    }
+
+def _stat_inputs(task_dir, sorted_files):
+    """
+    Stats the merge inputs from one scan of the task directory, so each
+    input is looked up once per merge rather than once per step.
+    
+    Args:
+        task_dir (str): Path to the task directory
+        sorted_files (list): (filename, order) pairs in merge order
+        
+    Returns:
+        dict: Filename to os.stat_result, for the inputs that exist
+    """
+    wanted = {filename for filename, _ in sorted_files}
+    file_stats = {}
+    try:
+        with os.scandir(task_dir) as entries:
+            for entry in entries:
+                if entry.name in wanted and entry.is_file():
+                    file_stats[entry.name] = entry.stat()
+    except OSError as e:
+        logger.error(f"Error listing {task_dir}: {str(e)}")
+    return file_stats
+
+def _looks_like_pdf(file_path, size):
+    """
+    Cheaply screens an input before parsing, so empty or non-PDF uploads are
+    rejected without a full parse.
+    
+    Args:
+        file_path (str): Path to the file
+        size (int): Size of the file in bytes
+        
+    Returns:
+        bool: True if the file is large enough and has a PDF header
+    """
+    if size < MIN_PDF_BYTES:
+        return False
+    try:
+        with open(file_path, 'rb') as f:
+            return b"%PDF-" in f.read(PDF_HEADER_WINDOW)
+    except OSError:
+        return False
+
+def _open_reader(file_path):
+    """
+    Parses a PDF, returning the error instead of raising so one bad input
+    does not abort the others.
+    
+    Args:
+        file_path (str): Path to the PDF
+        
+    Returns:
+        PdfReader or Exception: The reader, or the error that prevented parsing
+    """
+    try:
+        return PdfReader(file_path, strict=False)
+    except Exception as e:
+        return e
+
 class MergeWorkflow:
     """Handles the PDF merge workflow."""
     
     @staticmethod
-    def handle_pdf_save(task_dir, message_id, saved_filename):
+    def handle_pdf_save(task_dir, message_id, saved_filename, workflow_info):
         """
         Handles saving a PDF to the merge workflow's task directory.
         
@@ -23,19 +164,21 @@ class MergeWorkflow:
             task_dir (str): Path to the task directory
             message_id (str): Message ID of the received PDF
             saved_filename (str): Filename for the saved PDF
+            workflow_info (dict): Current workflow state
             
         Returns:
             str: The saved filename
         """
-        order_data = read_order_file(task_dir)
-        next_order = max(list(order_data.values()) + [0]) + 1
+        # The order lives in the workflow state and is written out once, on merge
+        order_data = workflow_info.setdefault("merge_order", {})
+        next_order = workflow_info.get("max_order", 0) + 1
+        workflow_info["max_order"] = next_order
         order_data[saved_filename] = next_order
-        write_order_file(task_dir, order_data)
         logger.info(f"Saved PDF {saved_filename} (order: {next_order})")
         return saved_filename
     
     @staticmethod
-    def handle_order_override(task_dir, target_filename, new_order_str):
+    def handle_order_override(task_dir, target_filename, new_order_str, workflow_info):
         """
         Handle order override for PDF merge workflow.
         
@@ -43,12 +186,13 @@ class MergeWorkflow:
             task_dir (str): Path to the task directory
             target_filename (str): Filename to reorder
             new_order_str (str): New order as string
+            workflow_info (dict): Current workflow state
             
         Returns:
             bool: True if successful, False if failed
             str: Message describing the result
         """
-        order_data = read_order_file(task_dir)
+        order_data = workflow_info.get("merge_order", {})
         
         if target_filename not in order_data:
             return False, "Cannot reorder the quoted message. Please reply directly to a PDF sent for this task."
@@ -59,75 +203,244 @@ class MergeWorkflow:
         except (ValueError, AssertionError):
             return False, f"'{new_order_str}' invalid positive number."
 
-        # Reorder logic
-        other_items = sorted(
-            [(fn, order) for fn, order in order_data.items() if fn != target_filename], 
-            key=lambda i: i[1]
-        )
-        new_order_map = {target_filename: new_order}
-        current_sequence_num = 1
-        
-        for filename, _ in other_items:
-            while current_sequence_num == new_order:
-                current_sequence_num += 1
-            new_order_map[filename] = current_sequence_num
-            current_sequence_num += 1
-
-        if write_order_file(task_dir, new_order_map):
-            return True, f"Order updated. The file is now number {new_order}."
-        else:
-            return False, "Failed to update order file."
+        new_order_map = reorder(order_data, target_filename, new_order)
+
+        workflow_info["merge_order"] = new_order_map
+        workflow_info["max_order"] = max(new_order_map.values())
+        return True, f"Order updated. The file is now number {new_order}."
     
     @staticmethod
-    def merge_pdfs_in_order(task_dir, order_data):
+    def merge_cache_key(task_dir, sorted_files, file_stats=None):
         """
-        Merges PDFs based on order_data and saves as Merged_pdf.pdf.
+        Builds a key identifying the merge inputs by name, position, size and
+        modification time.
         
         Args:
             task_dir (str): Path to the task directory
-            order_data (dict): Dictionary mapping filenames to their order
+            sorted_files (list): (filename, order) pairs in merge order
+            file_stats (dict): Stats of the inputs, read from task_dir if not given
+            
+        Returns:
+            str: SHA-1 hex digest of the inputs, or None if an input is missing
+        """
+        if file_stats is None:
+            file_stats = _stat_inputs(task_dir, sorted_files)
+        entries = []
+        for filename, _ in sorted_files:
+            stat_result = file_stats.get(filename)
+            if stat_result is None:
+                return None
+            entries.append([filename, stat_result.st_size, stat_result.st_mtime_ns])
+        return hashlib.sha1(json.dumps(entries).encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def merge_with_pikepdf(task_dir, sorted_files, output_path, file_stats=None):
+        """
+        Merges PDFs with qpdf, copying page streams without decoding them.
+        
+        Args:
+            task_dir (str): Path to the task directory
+            sorted_files (list): (filename, order) pairs in merge order
+            output_path (str): Path for the merged PDF
+            file_stats (dict): Stats of the inputs, read from task_dir if not given
             
         Returns:
             tuple: (output_path, missing_files)
         """
-        output_filename = "Merged_pdf.pdf"
-        output_path = os.path.join(task_dir, output_filename)
+        if file_stats is None:
+            file_stats = _stat_inputs(task_dir, sorted_files)
+        merged = pikepdf.Pdf.new()
+        sources = []  # Kept open until saved, since the merged pages reference them
+        missing_files = []
+        _prefetch([os.path.join(task_dir, filename) for filename, _ in sorted_files])
+        
+        try:
+            for filename, order in sorted_files:
+                file_path = os.path.join(task_dir, filename)
+                if filename not in file_stats:
+                    missing_files.append(filename)
+                elif not _looks_like_pdf(file_path, file_stats[filename].st_size):
+                    logger.error(f"Not a PDF: {filename}")
+                    missing_files.append(filename)
+                else:
+                    try:
+                        source = pikepdf.Pdf.open(file_path)
+                        sources.append(source)
+                        merged.pages.extend(source.pages)
+                    except Exception as e:
+                        logger.error(f"Error merging {filename}: {e}")
+                        missing_files.append(f"{filename}")
+            
+            if missing_files:
+                logger.error(f"Missing files: {', '.join(missing_files)}")
+                return None, missing_files
+            
+            if not sources:
+                logger.warning("No valid files to merge")
+                return None, []
+            
+            try:
+                merged.save(
+                    output_path,
+                    object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                    stream_decode_level=pikepdf.StreamDecodeLevel.none
+                )
+                logger.info("Merge completed successfully")
+                return output_path, []
+            except Exception as e:
+                logger.error(f"Error saving merged PDF: {str(e)}")
+                return None, []
+        finally:
+            merged.close()
+            for source in sources:
+                source.close()
+    
+    @staticmethod
+    def merge_with_pypdf(task_dir, sorted_files, output_path, file_stats=None):
+        """
+        Merges PDFs with pypdf, used when pikepdf is not installed.
+        
+        Args:
+            task_dir (str): Path to the task directory
+            sorted_files (list): (filename, order) pairs in merge order
+            output_path (str): Path for the merged PDF
+            file_stats (dict): Stats of the inputs, read from task_dir if not given
+            
+        Returns:
+            tuple: (output_path, missing_files)
+        """
+        if file_stats is None:
+            file_stats = _stat_inputs(task_dir, sorted_files)
         merger = PdfWriter()
         merged_something = False
         missing_files = []
+        
+        try:
+            # Parse the inputs concurrently; only appending to the writer is serial
+            present_files = []
+            for filename, order in sorted_files:
+                file_path = os.path.join(task_dir, filename)
+                if filename not in file_stats:
+                    missing_files.append(filename)
+                elif not _looks_like_pdf(file_path, file_stats[filename].st_size):
+                    logger.error(f"Not a PDF: {filename}")
+                    missing_files.append(filename)
+                else:
+                    present_files.append((filename, file_path))
+            
+            _prefetch([file_path for _, file_path in present_files])
+            
+            # Identical uploads (e.g. a PDF resent after a timeout) are parsed once
+            file_sizes = {file_path: file_stats[filename].st_size for filename, file_path in present_files}
+            content_keys = _content_keys(file_sizes)
+            unique_paths = {}
+            for file_path, content_key in content_keys.items():
+                unique_paths.setdefault(content_key, file_path)
+            
+            # Each reader holds its whole file in memory, so parse only a window
+            # ahead of the merge and drop every reader after its last use
+            last_use = {content_keys[file_path]: index for index, (_, file_path) in enumerate(present_files)}
+            to_parse = iter(unique_paths.items())
+            parsing = {}
+            
+            with ThreadPoolExecutor(max_workers=READER_WORKERS) as executor:
+                def parse_next():
+                    for content_key, file_path in to_parse:
+                        parsing[content_key] = executor.submit(_open_reader, file_path)
+                        return
+                
+                for _ in range(READER_WORKERS * 2):
+                    parse_next()
+                
+                for index, (filename, file_path) in enumerate(present_files):
+                    content_key = content_keys[file_path]
+                    while content_key not in parsing:
+                        parse_next()
+                    reader = parsing[content_key].result()
+                    
+                    try:
+                        if isinstance(reader, Exception):
+                            raise reader
+                        if MERGE_FAST_CONCAT:
+                            # Copy only the pages; document-level structure is left behind
+                            for page in reader.pages:
+                                merger.add_page(page)
+                        else:
+                            # Outlines are not carried over; rebuilding them is the costliest part of append
+                            merger.append(reader, import_outline=False)
+                        merged_something = True
+                    except Exception as e:
+                        logger.error(f"Error merging {filename}: {e}")
+                        missing_files.append(f"{filename}")
+                    
+                    if last_use[content_key] == index:
+                        del parsing[content_key]
+                        parse_next()
 
-        sorted_files = sorted(order_data.items(), key=lambda item: item[1])
-        logger.info(f"Merging {len(sorted_files)} PDFs")
+            if missing_files:
+                # Report in merge order
+                missing_files.sort(key=dict(sorted_files).get)
+                logger.error(f"Missing files: {', '.join(missing_files)}")
+                return None, missing_files
 
-        for filename, order in sorted_files:
-            file_path = os.path.join(task_dir, filename)
-            if os.path.exists(file_path):
-                try:
-                    merger.append(file_path)
-                    merged_something = True
-                except Exception as e:
-                    logger.error(f"Error merging {filename}: {e}")
-                    missing_files.append(f"{filename}")
-            else:
-                missing_files.append(filename)
-
-        if missing_files:
-            logger.error(f"Missing files: {', '.join(missing_files)}")
-            merger.close()
-            return None, missing_files
+            if not merged_something:
+                logger.warning("No valid files to merge")
+                return None, []
 
-        if not merged_something:
-            logger.warning("No valid files to merge")
+            try:
+                # The merged PDF is roughly the size of its inputs
+                _write_preallocated(output_path, sum(file_sizes[file_path] for _, file_path in present_files), merger.write)
+                logger.info("Merge completed successfully")
+                return output_path, []
+            except Exception as e:
+                logger.error(f"Error saving merged PDF: {str(e)}")
+                return None, []
+        finally:
             merger.close()
-            return None, []
+    
+    @staticmethod
+    def merge_pdfs_in_order(task_dir, order_data):
+        """
+        Merges PDFs based on order_data and saves as Merged_pdf.pdf.
+        
+        Args:
+            task_dir (str): Path to the task directory
+            order_data (dict): Dictionary mapping filenames to their order
+            
+        Returns:
+            tuple: (output_path, missing_files)
+        """
+        output_filename = "Merged_pdf.pdf"
+        output_path = os.path.join(task_dir, output_filename)
+        cache_path = os.path.join(task_dir, MERGE_CACHE_FILE)
 
-        try:
-            with open(output_path, "wb") as f_out:
-                merger.write(f_out)
-            merger.close()
-            logger.info("Merge completed successfully")
-            return output_path, []
-        except Exception as e:
-            logger.error(f"Error saving merged PDF: {str(e)}")
-            merger.close()
-            return None, []
+        sorted_files = sorted(order_data.items(), key=lambda item: item[1])
+        file_stats = _stat_inputs(task_dir, sorted_files)
+        
+        # Reuse the previous merge (e.g. when resending after a failed upload)
+        # if none of its inputs or their order has changed
+        cache_key = MergeWorkflow.merge_cache_key(task_dir, sorted_files, file_stats)
+        if cache_key and os.path.exists(output_path):
+            try:
+                with open(cache_path, 'r') as f:
+                    if json.load(f).get(cache_key) == output_filename:
+                        logger.info("Inputs unchanged since last merge, reusing merged PDF")
+                        return output_path, []
+            except (OSError, ValueError):
+                pass
+
+        logger.info(f"Merging {len(sorted_files)} PDFs")
+        if pikepdf is not None:
+            merged_path, missing_files = MergeWorkflow.merge_with_pikepdf(task_dir, sorted_files, output_path, file_stats)
+        else:
+            merged_path, missing_files = MergeWorkflow.merge_with_pypdf(task_dir, sorted_files, output_path, file_stats)
+        
+        # Only the latest merge is kept, since it overwrites the output file
+        if merged_path and cache_key:
+            try:
+                with open(cache_path, 'w') as f:
+                    json.dump({cache_key: output_filename}, f)
+            except OSError as e:
+                logger.warning(f"Could not record merge cache: {str(e)}")
+        
+        return merged_path, missing_files
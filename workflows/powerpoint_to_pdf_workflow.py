@@ -3,12 +3,12 @@ PowerPoint to PDF conversion workflow handler for the Document Scanner applicati
 """
 
 import os
-import time
 import logging
 import subprocess
-import shutil
+from pypdf import PdfWriter
 
-from utils.file_utils import read_order_file, write_order_file
+from utils.file_utils import ConvertedDocument, is_nonempty_file
+from utils.libreoffice_utils import libreoffice_profile
 
 logger = logging.getLogger(__name__)
 
@@ -33,7 +33,7 @@ class PowerPointToPdfWorkflow:
             abs_output_dir = os.path.abspath(output_dir)
             
             # Ensure input file exists and has size > 0
-            if not os.path.exists(abs_input_path) or os.path.getsize(abs_input_path) == 0:
+            if not is_nonempty_file(abs_input_path):
                 logger.error(f"Input file does not exist or is empty: {abs_input_path}")
                 return None
                 
@@ -47,21 +47,23 @@ class PowerPointToPdfWorkflow:
             
             # Run LibreOffice conversion
             logger.info(f"Converting PowerPoint to PDF using LibreOffice: {abs_input_path}")
-            cmd = [
-                'libreoffice',
-                '--headless',
-                '--convert-to', 'pdf',
-                '--outdir', abs_output_dir,
-                abs_input_path
-            ]
-            
-            process = subprocess.run(
-                cmd,
-                check=False,
-                capture_output=True,
-                text=True,
-                timeout=180  # 3 minutes timeout for large presentations
-            )
+            # Run on a profile no other conversion is using
+            with libreoffice_profile() as user_installation:
+                cmd = [
+                    'libreoffice',
+                    '--headless',
+                    user_installation,
+                    '--convert-to', 'pdf',
+                    '--outdir', abs_output_dir,
+                    abs_input_path
+                ]
+                process = subprocess.run(
+                    cmd,
+                    check=False,
+                    capture_output=True,
+                    text=True,
+                    timeout=180  # 3 minutes timeout for large presentations
+                )
             
             logger.info(f"LibreOffice process returned code: {process.returncode}")
             
@@ -72,7 +74,7 @@ class PowerPointToPdfWorkflow:
                 logger.warning(f"LibreOffice warnings: {process.stderr}")
             
             # Check if the output file exists
-            if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            if is_nonempty_file(output_path):
                 logger.info(f"Successfully converted to PDF: {output_path}")
                 return output_path
             else:
@@ -108,9 +110,8 @@ class PowerPointToPdfWorkflow:
             filename_base, filename_ext = os.path.splitext(saved_filename)
             
             # Try to get the original filename from the workflow_info
-            original_filename = None
-            if 'original_filenames' in workflow_info and message_id in workflow_info['original_filenames']:
-                original_filename = workflow_info['original_filenames'][message_id]
+            document = workflow_info.setdefault('documents', {}).setdefault(message_id, ConvertedDocument())
+            original_filename = document.original_name
             
             # If no original filename, use message_id as base
             if not original_filename:
@@ -142,14 +143,8 @@ class PowerPointToPdfWorkflow:
                 logger.info(f"Successfully converted to PDF: {pdf_filename}")
                 
                 # Store the file references in workflow info
-                if 'presentation_versions' not in workflow_info:
-                    workflow_info['presentation_versions'] = {}
-                
-                workflow_info['presentation_versions'][message_id] = {
-                    'original': saved_filename,
-                    'pdf': os.path.basename(output_pdf_path),
-                    'original_name': original_filename
-                }
+                document.original = saved_filename
+                document.pdf = os.path.basename(output_pdf_path)
                 
                 return saved_filename, f"PowerPoint presentation converted to PDF successfully. The PDF will be available when you type 'done'."
             else:
@@ -176,31 +171,32 @@ class PowerPointToPdfWorkflow:
         
         try:
             # Check if we have any presentations
-            if 'presentation_versions' not in workflow_info or not workflow_info['presentation_versions']:
+            documents = [
+                document for document in workflow_info.get('documents', {}).values()
+                if document.pdf
+            ]
+            if not documents:
                 logger.warning("No PowerPoint presentations received for conversion.")
                 return []
             
             # Collect all PDF files
-            for message_id, versions in workflow_info['presentation_versions'].items():
-                if 'pdf' in versions:
-                    pdf_path = os.path.join(task_dir, versions['pdf'])
-                    if os.path.exists(pdf_path):
-                        output_files.append(pdf_path)
-                        logger.info(f"Added PDF to result list: {versions['pdf']}")
-                    else:
-                        logger.warning(f"PDF file not found: {versions['pdf']}")
+            for document in documents:
+                pdf_path = os.path.join(task_dir, document.pdf)
+                if os.path.exists(pdf_path):
+                    output_files.append(pdf_path)
+                    logger.info(f"Added PDF to result list: {document.pdf}")
+                else:
+                    logger.warning(f"PDF file not found: {document.pdf}")
             
             # Create a merged PDF if multiple presentations were converted
             if len(output_files) > 1:
-                from pypdf import PdfReader, PdfWriter
-                
                 merged_pdf_path = os.path.join(task_dir, "Merged_Presentations.pdf")
                 writer = PdfWriter()
                 
+                # Append each document whole so pypdf copies its object tree in
+                # one pass instead of cloning pages one at a time
                 for pdf_path in output_files:
-                    reader = PdfReader(pdf_path)
-                    for page in reader.pages:
-                        writer.add_page(page)
+                    writer.append(pdf_path)
                 
                 with open(merged_pdf_path, "wb") as output_file:
                     writer.write(output_file)
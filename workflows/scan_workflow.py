@@ -3,18 +3,19 @@ Document Scan workflow handler for the Document Scanner application.
 """
 
 import os
-import time
 import logging
 import subprocess
-import io
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from pypdf import PdfReader, PdfWriter
 
 from config.settings import SCAN_VERSIONS
-from utils.file_utils import read_order_file, write_order_file
+from utils.file_utils import reorder
 
 logger = logging.getLogger(__name__)
 
+# Absolute path to scanner.py, resolved once rather than for every image
+SCANNER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scanner', 'scanner.py')
+
 class ScanWorkflow:
     """Handles the document scan workflow."""
     
@@ -37,13 +38,9 @@ class ScanWorkflow:
         # Process the image with scanner.py
         try:
             # Call scanner program with correct python command
-            # Fix: Use the absolute path to scanner.py in the Document-Scanner-Restructured directory
-            scanner_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 
-                                      'scanner', 'scanner.py')
-            
             logger.info(f"Running scanner on: {file_path}")
             process = subprocess.run(
-                ['python', scanner_path, '--image', file_path, '--output', task_dir],
+                ['python', SCANNER_PATH, '--image', file_path, '--output', task_dir],
                 check=True,
                 capture_output=True,
                 text=True
@@ -63,25 +60,8 @@ class ScanWorkflow:
                 'enhanced': f"{message_id}_magic_color_enhanced.png"
             }
             
-            # Add a waiting/checking mechanism to ensure B&W version is complete
-            bw_file_path = os.path.join(task_dir, f"{message_id}_BW.jpg")
-            max_wait_time = 30  # Maximum seconds to wait for BW processing
-            wait_interval = 1   # Check every second
-            wait_time = 0
-            
-            while wait_time < max_wait_time:
-                if os.path.exists(bw_file_path):
-                    # Check if file is fully written (not still being processed)
-                    try:
-                        with open(bw_file_path, "rb+") as f:
-                            # If we can open the file for reading and writing, it's complete
-                            break
-                    except IOError:
-                        pass
-                
-                time.sleep(wait_interval)
-                wait_time += wait_interval
-            
+            # scanner.py writes every version before it exits, so once the
+            # subprocess has returned the files are either complete or missing
             # Check if processed files exist
             for version_type, version_filename in versions.items():
                 version_path = os.path.join(task_dir, version_filename)
@@ -98,21 +78,17 @@ class ScanWorkflow:
             logger.error(f"Scanner failed for {file_path}: {str(e)}")
             logger.error(f"Scanner error output: {e.stderr}")
         
-        # Update order data
-        order_data = read_order_file(task_dir) or {}  # Initialize if None
-        next_order = max(list(order_data.values()) + [0]) + 1
+        # The order lives in the workflow state and is written out once, on 'done'
+        order_data = workflow_info.setdefault("scan_order", {})
+        next_order = workflow_info.get("max_order", 0) + 1
+        workflow_info["max_order"] = next_order
         order_data[saved_filename] = next_order
+        logger.info(f"Saved image {saved_filename} (order: {next_order})")
         
-        # Write order file
-        if write_order_file(task_dir, order_data):
-            logger.info(f"Updated order file with image {saved_filename} as number {next_order}")
-        else:
-            logger.error("Failed to write order file")
-
         return saved_filename, f"Image {next_order} received and processed. Send another or type 'done'."
     
     @staticmethod
-    def handle_order_override(task_dir, target_filename, new_order_str):
+    def handle_order_override(task_dir, target_filename, new_order_str, workflow_info):
         """
         Handle order override for scan workflow.
         
@@ -120,12 +96,13 @@ class ScanWorkflow:
             task_dir (str): Path to the task directory
             target_filename (str): Filename to reorder
             new_order_str (str): New order as string
+            workflow_info (dict): Current workflow state
             
         Returns:
             bool: True if successful, False if failed
             str: Message describing the result
         """
-        order_data = read_order_file(task_dir)
+        order_data = workflow_info.get("scan_order", {})
         
         if target_filename not in order_data:
             return False, "Cannot reorder the quoted message. Please reply directly to an image sent for this task."
@@ -136,24 +113,60 @@ class ScanWorkflow:
         except (ValueError, AssertionError):
             return False, f"'{new_order_str}' invalid positive number."
 
-        # Reorder logic
-        other_items = sorted(
-            [(fn, order) for fn, order in order_data.items() if fn != target_filename], 
-            key=lambda i: i[1]
-        )
-        new_order_map = {target_filename: new_order}
-        current_sequence_num = 1
+        new_order_map = reorder(order_data, target_filename, new_order)
+        workflow_info["scan_order"] = new_order_map
+        workflow_info["max_order"] = max(new_order_map.values())
+        return True, f"Order updated. The image is now number {new_order}."
+    
+    @staticmethod
+    def create_version_pdf(task_dir, sorted_images, version):
+        """
+        Creates the PDF for one scan version from the ordered images.
         
-        for filename, _ in other_items:
-            while current_sequence_num == new_order:
-                current_sequence_num += 1
-            new_order_map[filename] = current_sequence_num
-            current_sequence_num += 1
-
-        if write_order_file(task_dir, new_order_map):
-            return True, f"Order updated. The image is now number {new_order}."
-        else:
-            return False, "Failed to update order file."
+        Args:
+            task_dir (str): Path to the task directory
+            sorted_images (list): (filename, order) pairs in page order
+            version (dict): Version configuration with 'name' and 'suffix'
+            
+        Returns:
+            str: Path to the created PDF, or None if it could not be written
+        """
+        pdf_name = f"Scanned_Document_{version['name']}.pdf"
+        output_path = os.path.join(task_dir, pdf_name)
+        page_count = 0
+        is_original = version['name'] == 'original'
+        version_suffix = f"{version['suffix']}.jpg"
+        
+        # Pages are appended to the PDF one at a time, so only one decoded
+        # image is held in memory however many pages the document has
+        for image_filename, _ in sorted_images:
+            msg_id = image_filename.split('.')[0]
+            
+            # Get the right file based on version
+            img_path = os.path.join(task_dir, image_filename if is_original else msg_id + version_suffix)
+            
+            try:
+                with Image.open(img_path) as img:
+                    page = img if img.mode in ("RGB", "L", "1", "CMYK") else img.convert("RGB")
+                    try:
+                        page.save(output_path, format="PDF", append=page_count > 0)
+                    finally:
+                        if page is not img:
+                            page.close()
+                page_count += 1
+                logger.info(f"Added {version['name']} version of {image_filename} to PDF")
+            except FileNotFoundError:
+                # Skip if file doesn't exist
+                logger.warning(f"Missing {version['name']} version for {msg_id}, skipping this image")
+            except Exception as e:
+                logger.error(f"Error adding {img_path} to PDF: {e}")
+        
+        if not page_count:
+            logger.warning(f"No images available for {pdf_name}")
+            return None
+        
+        logger.info(f"Created PDF: {pdf_name}")
+        return output_path
     
     @staticmethod
     def create_pdfs_from_images(task_dir, order_data, versions=None):
@@ -177,52 +190,18 @@ class ScanWorkflow:
 
         # Get sorted images list
         sorted_images = sorted(order_data.items(), key=lambda x: x[1])
-        output_files = []
         
         try:
-            # Create PDF for each version type
-            for version in versions:
-                writer = PdfWriter()
-                pdf_name = f"Scanned_Document_{version['name']}.pdf"
-                output_path = os.path.join(task_dir, pdf_name)
-                
-                # Convert each image to PDF and append
-                for image_filename, _ in sorted_images:
-                    msg_id = image_filename.split('.')[0]
-                    
-                    # Get the right file based on version
-                    if version['name'] == 'original':
-                        img_path = os.path.join(task_dir, image_filename)
-                    else:
-                        img_path = os.path.join(task_dir, f"{msg_id}{version['suffix']}.jpg")
-                    
-                    # Skip if file doesn't exist
-                    if not os.path.exists(img_path):
-                        logger.warning(f"Missing {version['name']} version for {msg_id}, skipping this image")
-                        continue
-                        
-                    # Convert image to PDF and add to writer
-                    try:
-                        img = Image.open(img_path)
-                        img_width, img_height = img.size
-                        pdf_page = io.BytesIO()
-                        img.save(pdf_page, format="PDF")
-                        pdf_page.seek(0)
-                        
-                        reader = PdfReader(pdf_page)
-                        writer.add_page(reader.pages[0])
-                        logger.info(f"Added {version['name']} version of {image_filename} to PDF")
-                    except Exception as e:
-                        logger.error(f"Error adding {img_path} to PDF: {e}")
-                
-                # Save the PDF
-                try:
-                    with open(output_path, "wb") as output_file:
-                        writer.write(output_file)
-                    output_files.append(output_path)
-                    logger.info(f"Created PDF: {pdf_name}")
-                except Exception as e:
-                    logger.error(f"Error writing PDF {pdf_name}: {e}")
+            # Each version is an independent PDF; Pillow and zlib release the GIL
+            # while encoding, so the versions are built concurrently, one per core.
+            # Each version holds a single decoded page at a time, so memory is
+            # bounded by the worker count, not by the number of pages.
+            with ThreadPoolExecutor(max_workers=min(len(versions), os.cpu_count() or 1)) as executor:
+                created = executor.map(
+                    lambda version: ScanWorkflow.create_version_pdf(task_dir, sorted_images, version),
+                    versions
+                )
+                output_files = [output_path for output_path in created if output_path]
             
             return output_files
             
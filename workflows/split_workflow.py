@@ -5,10 +5,44 @@ PDF Split workflow handler for the Document Scanner application.
 import os
 import re
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader, PdfWriter
 
 logger = logging.getLogger(__name__)
 
+# Below this many pages, worker process startup costs more than it saves
+PARALLEL_SPLIT_MIN_PAGES = 100
+
+def _write_split(source, start_page, end_page, output_path):
+    """
+    Writes one page range of a PDF to its own file.
+    
+    Args:
+        source (PdfReader or str): Open reader, or the PDF path to open
+        start_page (int): First page, 1-based
+        end_page (int): Last page, inclusive
+        output_path (str): Path for the split file
+        
+    Returns:
+        int: Number of pages written, 0 if the range was empty and no file was created
+    """
+    reader = PdfReader(source) if isinstance(source, str) else source
+    writer = PdfWriter()
+    pages_added = 0
+    
+    for page_num_zero_based in range(start_page - 1, end_page):
+        try: 
+            writer.add_page(reader.pages[page_num_zero_based])
+            pages_added += 1
+        except IndexError: 
+            break  # Stop adding for this range if error
+    
+    if pages_added > 0:
+        with open(output_path, "wb") as f_out: 
+            writer.write(f_out)
+    return pages_added
+
 class SplitWorkflow:
     """Handles the PDF split workflow."""
     
@@ -147,35 +181,48 @@ class SplitWorkflow:
         output_files = []  # List to store paths of created split files
         
         try:
-            reader = PdfReader(source_pdf_path)
             source_base_name = os.path.splitext(source_pdf_filename)[0]
+            jobs = [
+                (
+                    split["start"],
+                    split["end"],
+                    os.path.join(task_dir, f"{source_base_name}_pages_{split['start']}-{split['end']}.pdf")
+                )
+                for split in split_definitions
+            ]
+            total_pages = sum(end_page - start_page + 1 for start_page, end_page, _ in jobs)
             
-            for split in split_definitions:
-                start_page = split["start"]
-                end_page = split["end"]
-                writer = PdfWriter()
-                pages_added = 0
-                
-                for page_num_zero_based in range(start_page - 1, end_page):
-                    try: 
-                        writer.add_page(reader.pages[page_num_zero_based])
-                        pages_added += 1
-                    except IndexError: 
-                        break  # Stop adding for this range if error
-                        
-                if pages_added > 0:
-                    output_filename = f"{source_base_name}_pages_{start_page}-{end_page}.pdf"
-                    output_path = os.path.join(task_dir, output_filename)
-                    
+            if len(jobs) > 1 and total_pages >= PARALLEL_SPLIT_MIN_PAGES:
+                # Large splits: each worker process parses the source and writes its own ranges
+                workers = min(len(jobs), os.cpu_count() or 1)
+                with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    futures = [
+                        executor.submit(_write_split, source_pdf_path, start_page, end_page, output_path)
+                        for start_page, end_page, output_path in jobs
+                    ]
+                    outcomes = []
+                    for future in futures:
+                        try:
+                            outcomes.append(future.result())
+                        except Exception as e:
+                            outcomes.append(e)
+            else:
+                reader = PdfReader(source_pdf_path)
+                outcomes = []
+                for start_page, end_page, output_path in jobs:
                     try:
-                        with open(output_path, "wb") as f_out: 
-                            writer.write(f_out)
-                        output_files.append({
-                            "path": output_path, 
-                            "range": f"{start_page}-{end_page}"
-                        })
-                    except Exception as e: 
-                        logger.error(f"Error writing split file {output_filename}: {str(e)}")
+                        outcomes.append(_write_split(reader, start_page, end_page, output_path))
+                    except Exception as e:
+                        outcomes.append(e)
+            
+            for (start_page, end_page, output_path), outcome in zip(jobs, outcomes):
+                if isinstance(outcome, Exception):
+                    logger.error(f"Error writing split file {os.path.basename(output_path)}: {str(outcome)}")
+                elif outcome > 0:
+                    output_files.append({
+                        "path": output_path, 
+                        "range": f"{start_page}-{end_page}"
+                    })
                         
             return output_files
             
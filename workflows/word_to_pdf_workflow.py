@@ -3,14 +3,14 @@ Word to PDF conversion workflow handler for the Document Scanner application.
 """
 
 import os
-import time
 import logging
 import subprocess
-import shutil
+from pypdf import PdfWriter
 
 # Removed docx2pdf import since we'll use LibreOffice instead
 
-from utils.file_utils import read_order_file, write_order_file
+from utils.file_utils import ConvertedDocument
+from utils.libreoffice_utils import libreoffice_profile
 
 logger = logging.getLogger(__name__)
 
@@ -31,21 +31,22 @@ class WordToPdfWorkflow:
         """
         try:
             # Create a command to use LibreOffice in headless mode for conversion
-            cmd = [
-                'libreoffice', 
-                '--headless', 
-                '--convert-to', 'pdf', 
-                '--outdir', output_dir,
-                input_path
-            ]
-            
-            # Execute the command
-            process = subprocess.run(
-                cmd,
-                check=True,
-                capture_output=True,
-                text=True
-            )
+            # Execute the command on a profile no other conversion is using
+            with libreoffice_profile() as user_installation:
+                cmd = [
+                    'libreoffice', 
+                    '--headless', 
+                    user_installation,
+                    '--convert-to', 'pdf', 
+                    '--outdir', output_dir,
+                    input_path
+                ]
+                process = subprocess.run(
+                    cmd,
+                    check=True,
+                    capture_output=True,
+                    text=True
+                )
             
             # Get the output filename
             input_filename = os.path.basename(input_path)
@@ -92,9 +93,8 @@ class WordToPdfWorkflow:
             filename_base, filename_ext = os.path.splitext(saved_filename)
             
             # Try to get the original filename from the workflow_info
-            original_filename = None
-            if 'original_filenames' in workflow_info and message_id in workflow_info['original_filenames']:
-                original_filename = workflow_info['original_filenames'][message_id]
+            document = workflow_info.setdefault('documents', {}).setdefault(message_id, ConvertedDocument())
+            original_filename = document.original_name
             
             # If no original filename, use message_id as base
             if not original_filename:
@@ -126,14 +126,8 @@ class WordToPdfWorkflow:
                 logger.info(f"Successfully converted to PDF: {pdf_filename}")
                 
                 # Store the file references in workflow info
-                if 'document_versions' not in workflow_info:
-                    workflow_info['document_versions'] = {}
-                
-                workflow_info['document_versions'][message_id] = {
-                    'original': saved_filename,
-                    'pdf': os.path.basename(output_pdf_path),
-                    'original_name': original_filename
-                }
+                document.original = saved_filename
+                document.pdf = os.path.basename(output_pdf_path)
                 
                 return saved_filename, f"Word document converted to PDF successfully. The PDF will be available when you type 'done'."
             else:
@@ -160,31 +154,32 @@ class WordToPdfWorkflow:
         
         try:
             # Check if we have any documents
-            if 'document_versions' not in workflow_info or not workflow_info['document_versions']:
+            documents = [
+                document for document in workflow_info.get('documents', {}).values()
+                if document.pdf
+            ]
+            if not documents:
                 logger.warning("No documents received for conversion.")
                 return []
             
             # Collect all PDF files
-            for message_id, versions in workflow_info['document_versions'].items():
-                if 'pdf' in versions:
-                    pdf_path = os.path.join(task_dir, versions['pdf'])
-                    if os.path.exists(pdf_path):
-                        output_files.append(pdf_path)
-                        logger.info(f"Added PDF to result list: {versions['pdf']}")
-                    else:
-                        logger.warning(f"PDF file not found: {versions['pdf']}")
+            for document in documents:
+                pdf_path = os.path.join(task_dir, document.pdf)
+                if os.path.exists(pdf_path):
+                    output_files.append(pdf_path)
+                    logger.info(f"Added PDF to result list: {document.pdf}")
+                else:
+                    logger.warning(f"PDF file not found: {document.pdf}")
             
             # Create a merged PDF if multiple documents were converted
             if len(output_files) > 1:
-                from pypdf import PdfReader, PdfWriter
-                
                 merged_pdf_path = os.path.join(task_dir, "Merged_Documents.pdf")
                 writer = PdfWriter()
                 
+                # Append each document whole so pypdf copies its object tree in
+                # one pass instead of cloning pages one at a time
                 for pdf_path in output_files:
-                    reader = PdfReader(pdf_path)
-                    for page in reader.pages:
-                        writer.add_page(page)
+                    writer.append(pdf_path)
                 
                 with open(merged_pdf_path, "wb") as output_file:
                     writer.write(output_file)